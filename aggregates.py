@@ -0,0 +1,170 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from storage import CHUNK_POLLS, SNAPSHOT_DIR, iter_snapshot_chunks
+
+AGGREGATES_PATH = "aggregates.npz"
+
+TIME_VARIABLE = "day_hour_of_week_num"
+N_SLOTS = 7 * 24
+
+# Metrics accumulated per (station, weekday-hour). The occupancy rates are derived from the mean counts and the
+# current capacity when the aggregates are read, exactly as the mean of the per-poll ratios would be.
+ACCUMULATED = ['num_bikes_available',
+               'num_docks_available',
+               'num_mech_bikes_available',
+               'num_ebikes_available',
+               'frac_mech',
+               'frac_ebikes',
+               'diff_ebikes',
+               'diff_mech_bikes'
+               ]
+
+# Counts remembered per station for the diff metrics
+LAST_SEEN = ['num_ebikes_available', 'num_mech_bikes_available', 'num_bikes_available']
+
+SNAPSHOT_COLUMNS = ['station_id', 'is_renting', 'num_bikes_available', 'num_docks_available',
+                    'num_mech_bikes_available', 'num_ebikes_available', 'date_retrieved']
+
+
+def slot_of(dates):
+    dates = pd.DatetimeIndex(dates)
+    return dates.weekday.to_numpy() * 24 + dates.hour.to_numpy()
+
+
+def slot_to_day_hour(slots):
+    return 100 * (slots // 24) + slots % 24
+
+
+class AggregateState:
+    def __init__(self, station_ids=None, sums=None, counts=None, last_seen=None, last_date=None, first_date=None):
+        n_stations = 0 if station_ids is None else len(station_ids)
+        shape = (n_stations, N_SLOTS, len(ACCUMULATED))
+        self.station_ids = np.zeros(0, dtype="int64") if station_ids is None else station_ids
+        self.sums = np.zeros(shape) if sums is None else sums
+        self.counts = np.zeros(shape, dtype="int64") if counts is None else counts
+        self.last_seen = np.full((n_stations, len(LAST_SEEN)), np.nan) if last_seen is None else last_seen
+        self.last_date = last_date
+        # Date of the first poll folded in, None for states saved before it was kept
+        self.first_date = first_date
+        self._rows = {id_: row for row, id_ in enumerate(self.station_ids)}
+
+    def _station_rows(self, station_ids):
+        new_ids = [id_ for id_ in pd.unique(station_ids) if id_ not in self._rows]
+        if new_ids:
+            n_new = len(new_ids)
+            for id_ in new_ids:
+                self._rows[id_] = len(self._rows)
+            self.station_ids = np.concatenate([self.station_ids, np.asarray(new_ids, dtype="int64")])
+            self.sums = np.concatenate([self.sums, np.zeros((n_new,) + self.sums.shape[1:])])
+            self.counts = np.concatenate([self.counts, np.zeros((n_new,) + self.counts.shape[1:], dtype="int64")])
+            self.last_seen = np.concatenate([self.last_seen, np.full((n_new, len(LAST_SEEN)), np.nan)])
+        return np.array([self._rows[id_] for id_ in station_ids], dtype="int64")
+
+    def update(self, snapshot, exclusions=None):
+        return self.update_chunk(snapshot, exclusions) > 0
+
+    def update_chunk(self, chunk, exclusions=None):
+        # Folds in any number of polls, those not newer than last_date being skipped. Each (station, slot) sums its
+        # values in date order, so the result is the same as updating poll by poll. The rows masked by exclusions
+        # (see outages.py) are left out like those of stations not renting.
+        # The dates of the polls passed by the collector are strings
+        dates = pd.to_datetime(chunk.date_retrieved).to_numpy()
+        if self.last_date is not None:
+            newer = dates > np.datetime64(self.last_date)
+            chunk, dates = chunk[newer], dates[newer]
+        if not len(chunk):
+            return 0
+        n_polls = len(np.unique(dates))
+        if self.last_date is None:
+            self.first_date = pd.Timestamp(dates.min())
+        self.last_date = pd.Timestamp(dates.max())
+
+        keep = chunk.is_renting.to_numpy() == 1
+        if exclusions is not None:
+            keep &= ~exclusions.mask(chunk.station_id.to_numpy(), dates)
+        df, dates = chunk[keep], dates[keep]
+        # Polls where no station is renting, or all are flagged, still move last_date
+        if not len(df):
+            return n_polls
+        order = np.lexsort((dates, df.station_id.to_numpy()))
+        df, dates = df.iloc[order], dates[order]
+        rows = self._station_rows(df.station_id.to_numpy())
+        slots = slot_of(dates)
+
+        # Diffs against the previous poll of the station, in the chunk or remembered from the previous ones
+        seen = df[LAST_SEEN].to_numpy(dtype="float64")
+        first = np.append(True, rows[1:] != rows[:-1])
+        last = np.append(rows[1:] != rows[:-1], True)
+        previous = np.roll(seen, 1, axis=0)
+        previous[first] = self.last_seen[rows[first]]
+        diffs = seen - previous
+        self.last_seen[rows[last]] = seen[last]
+
+        bikes = df.num_bikes_available.to_numpy(dtype="float64")
+        mech = df.num_mech_bikes_available.to_numpy(dtype="float64")
+        ebikes = df.num_ebikes_available.to_numpy(dtype="float64")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = np.column_stack([bikes,
+                                      df.num_docks_available.to_numpy(dtype="float64"),
+                                      mech,
+                                      ebikes,
+                                      mech / bikes,
+                                      ebikes / bikes,
+                                      diffs[:, 0],
+                                      diffs[:, 1]])
+
+        # The mean in preprocess skips missing values, so they are not counted either
+        valid = ~np.isnan(values)
+        np.add.at(self.sums, (rows, slots), np.where(valid, values, 0))
+        np.add.at(self.counts, (rows, slots), valid)
+        return n_polls
+
+    def update_from_store(self, root=SNAPSHOT_DIR, start=None, end=None, chunk_polls=CHUNK_POLLS, exclusions=None):
+        n_polls = 0
+        start = self.last_date if start is None else start
+        for chunk in iter_snapshot_chunks(root, start, end, SNAPSHOT_COLUMNS, chunk_polls):
+            n_polls += self.update_chunk(chunk, exclusions)
+        return n_polls
+
+    def to_frame(self, stations_df):
+        rows, slots = np.nonzero(self.counts[:, :, 0])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            means = self.sums[rows, slots] / self.counts[rows, slots]
+
+        df = pd.DataFrame(means, columns=ACCUMULATED)
+        df.insert(0, "station_id", self.station_ids[rows])
+        df.insert(1, TIME_VARIABLE, slot_to_day_hour(slots))
+        df = df.join(stations_df, on="station_id", how="inner")
+
+        df["occupancy"] = df.num_bikes_available / df.capacity
+        df["occupancy_mech"] = df.num_mech_bikes_available / df.capacity
+        df["occupancy_ebikes"] = df.num_ebikes_available / df.capacity
+        return df
+
+    def covers(self, start, end):
+        # Whether the polls from start to end were folded in, as far as the dates tell: not when the state was
+        # started over after start, e.g. without the stored polls
+        return self.first_date is not None and self.first_date <= start and self.last_date >= end
+
+    def save(self, path=AGGREGATES_PATH):
+        tmp_path = path + ".tmp"
+        first_date, last_date = [np.datetime64(date, "s") if date is not None else np.datetime64("NaT", "s")
+                                 for date in (self.first_date, self.last_date)]
+        with open(tmp_path, "wb") as f:
+            np.savez(f, station_ids=self.station_ids, sums=self.sums, counts=self.counts, last_seen=self.last_seen,
+                     last_date=last_date, first_date=first_date)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=AGGREGATES_PATH):
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path) as data:
+            first_date, last_date = [data[name][()] if name in data.files else np.datetime64("NaT", "s")
+                                     for name in ("first_date", "last_date")]
+            first_date, last_date = [pd.Timestamp(date) if not np.isnat(date) else None
+                                     for date in (first_date, last_date)]
+            return cls(data["station_ids"], data["sums"], data["counts"], data["last_seen"], last_date, first_date)
@@ -1,40 +1,55 @@
-import sys
 import time
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
-import requests
 
+from aggregates import AGGREGATES_PATH
+from storage import SNAPSHOT_DIR
 
-def request_and_write():
-    req = requests.get("https://velib-metropole-opendata.smoove.pro/opendata/Velib_Metropole/station_status.json")
-    data = req.json()
+STATUS_URL = "https://velib-metropole-opendata.smoove.pro/opendata/Velib_Metropole/station_status.json"
+INFORMATION_URL = "https://velib-metropole-opendata.smoove.pro/opendata/Velib_Metropole/station_information.json"
 
+# "{is_installed}{is_returning}{is_renting}" for every combination of the 0/1 flags
+FUNCTIONING_WORDS = np.array(["{:03b}".format(i) for i in range(8)])
+
+
+def local_datetimes(timestamps):
+    # Same as datetime.fromtimestamp, but the UTC offset is only looked up once per distinct hour
+    hours, inverse = np.unique(timestamps // 3600, return_inverse=True)
+    offsets = np.array([time.localtime(h * 3600).tm_gmtoff for h in hours])
+    return (timestamps + offsets[inverse.ravel()]).astype("datetime64[s]")
+
+
+def status_to_frame(data, date_retrieved):
     df = pd.DataFrame(data["data"]["stations"])
 
     # Preprocess
-    df["num_mech_bikes_available"] = df.num_bikes_available_types.apply(lambda x: x[0]["mechanical"])
-    df["num_ebikes_available"] = df.num_bikes_available_types.apply(lambda x: x[1]["ebike"])
-    df["legible_last_reported"] = df.last_reported.apply(datetime.fromtimestamp)
-    df["functioning_word"] = df.is_installed.apply(str) + df.is_returning.apply(str) + df.is_renting.apply(str)
+    bike_types = df.num_bikes_available_types.str
+    df["num_mech_bikes_available"] = bike_types[0].str["mechanical"].to_numpy("int64")
+    df["num_ebikes_available"] = bike_types[1].str["ebike"].to_numpy("int64")
+    df["legible_last_reported"] = local_datetimes(df.last_reported.to_numpy())
+    df["functioning_word"] = FUNCTIONING_WORDS[4 * df.is_installed + 2 * df.is_returning + df.is_renting]
     df = df.drop(["numBikesAvailable", "numDocksAvailable", "num_bikes_available_types"], axis=1)
     df["lastUpdated"] = datetime.fromtimestamp(data["lastUpdatedOther"])
-    df["date_retrieved"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    df.to_csv("velib_data_with_date.csv", mode="a", header=False)
+    df["date_retrieved"] = date_retrieved.strftime("%Y-%m-%d %H:%M:%S")
+    return df
+
+
+def request_and_write(root=SNAPSHOT_DIR, state_path=AGGREGATES_PATH, url=STATUS_URL):
+    # One poll processed as the collector does, so that the outage detector runs and the stations it flags are left
+    # out of the aggregates
+    from poller import Collector
+    collector = Collector(status_url=url, root=root, state_path=state_path)
+    try:
+        req = collector.session.get(url, timeout=collector.timeout)
+        req.raise_for_status()
+        collector.process(req.json(), datetime.now())
+    finally:
+        collector.session.close()
     return 0
 
 
 if __name__ == "__main__":
-    while True:
-        try:
-            request_and_write()
-        except Exception as e:
-            sys.stdout.write(e)
-            time.sleep(60)
-            continue
-        for remaining in range(15 * 60, 0, -1):
-            sys.stdout.write("\r")
-            sys.stdout.write("{:2d} seconds remaining.".format(remaining))
-            sys.stdout.flush()
-            time.sleep(1)
-        sys.stdout.write("\rAgain!            \n")
+    from poller import main
+    main()
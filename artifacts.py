@@ -0,0 +1,119 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from binning import HexGrid
+from data_process import METRICS, TIME_VARIABLE
+from downsample import Rollups
+from frames import FrameSlices
+from station_index import StationIndex
+
+ARTIFACTS_DIR = "artifacts"
+CURRENT = "current"
+KEEP_VERSIONS = 2
+LOCK_NAME = "build.lock"
+
+HISTORY_COLUMN = "num_bikes_available"
+
+
+def write_frame(df, directory):
+    # One .npy per column, strings being stored as categorical codes
+    os.makedirs(directory, exist_ok=True)
+    categories = {}
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if not (pd.api.types.is_numeric_dtype(values) or pd.api.types.is_datetime64_any_dtype(values)):
+            values = values.astype("category")
+            categories[column] = {"categories": values.cat.categories.tolist(), "ordered": values.cat.ordered}
+            values = values.cat.codes
+        np.save(os.path.join(directory, "{}.npy".format(i)), values.to_numpy())
+
+    with open(os.path.join(directory, "frame.json"), "w") as f:
+        json.dump({"columns": list(df.columns), "categories": categories}, f)
+
+
+def read_frame(directory, mmap_mode="r"):
+    with open(os.path.join(directory, "frame.json")) as f:
+        meta = json.load(f)
+
+    columns = {}
+    for i, column in enumerate(meta["columns"]):
+        values = np.load(os.path.join(directory, "{}.npy".format(i)), mmap_mode=mmap_mode)
+        if column in meta["categories"]:
+            values = pd.Categorical.from_codes(values, **meta["categories"][column])
+        columns[column] = values
+    return pd.DataFrame(columns, copy=False)
+
+
+def current_version(artifacts_dir=ARTIFACTS_DIR):
+    path = os.path.join(artifacts_dir, CURRENT)
+    return os.path.realpath(path) if os.path.exists(path) else None
+
+
+def publish(version_dir, artifacts_dir=ARTIFACTS_DIR):
+    # Readers follow the "current" link, which is swapped atomically once the new version is complete
+    tmp_link = os.path.join(artifacts_dir, CURRENT + ".tmp")
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.basename(version_dir), tmp_link)
+    os.replace(tmp_link, os.path.join(artifacts_dir, CURRENT))
+
+    # Files of older versions stay readable by the processes that still map them, even once removed
+    versions = sorted(x for x in os.listdir(artifacts_dir) if os.path.isdir(os.path.join(artifacts_dir, x))
+                      and not os.path.islink(os.path.join(artifacts_dir, x)))
+    for version in versions[:-KEEP_VERSIONS]:
+        version_path = os.path.join(artifacts_dir, version)
+        for root, dirs, files in os.walk(version_path, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+            os.rmdir(root)
+
+
+@contextmanager
+def build_lock(artifacts_dir=ARTIFACTS_DIR, blocking=True):
+    # Only one process builds at a time, yields whether the lock was taken
+    os.makedirs(artifacts_dir, exist_ok=True)
+    with open(os.path.join(artifacts_dir, LOCK_NAME), "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class Artifacts:
+    # Everything the dashboard serves, read from a built version with the large arrays memory-mapped
+
+    def __init__(self, directory, mmap_mode="r"):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.date_last_updated = pd.Timestamp(self.meta["date_last_updated"])
+
+        self.group_by_geo_timeslice_df = read_frame(os.path.join(directory, "timeslice"), mmap_mode)
+        self.cluster_df = read_frame(os.path.join(directory, "clusters"), mmap_mode)
+        self.cluster_centers = np.load(os.path.join(directory, "cluster_centers.npy"), mmap_mode=mmap_mode)
+        self.history_rollups = Rollups.load(os.path.join(directory, "rollups"), HISTORY_COLUMN, mmap_mode=mmap_mode)
+
+        # Small lookup structures, bounded by the number of stations rather than the history
+        self.frame_slices = FrameSlices(self.group_by_geo_timeslice_df, METRICS)
+        self.hex_grid = HexGrid(self.frame_slices)
+        self.timeslice_index = StationIndex(self.group_by_geo_timeslice_df, TIME_VARIABLE)
+        # One row per station for the clustering map, the hover showing its mean over the weekday-hours
+        self.cluster_stations = self.cluster_df.groupby(["station_id", "Cluster"], observed=True, sort=False).agg(
+            name=("name", "first"), lat=("lat", "first"), lon=("lon", "first"),
+            num_bikes_available=("num_bikes_available", "mean")).reset_index()
+        self.cluster_of_station = dict(
+            self.cluster_df.drop_duplicates("station_id")[["station_id", "Cluster"]].astype(object).to_numpy())
+
+
+def load_artifacts(artifacts_dir=ARTIFACTS_DIR, mmap_mode="r"):
+    return Artifacts(current_version(artifacts_dir), mmap_mode)
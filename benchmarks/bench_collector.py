@@ -0,0 +1,177 @@
+import argparse
+import asyncio
+import copy
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from aggregates import AggregateState
+from poller import MIN_PERIOD, Collector
+from storage import list_snapshots
+from synthetic import station_information_payload, status_payloads
+
+INFORMATION_ETAG = '"information-v1"'
+
+
+class StubServer:
+    # Local stand-in for both feeds. The status answers are taken in order from a queue, either a payload or an HTTP
+    # error code, the last payload being served again once it is empty. station_information answers 304 to a
+    # request revalidating its ETag.
+
+    def __init__(self, information, delay=0.0):
+        self.information = json.dumps(information).encode()
+        self.delay = delay
+        self.queue = []
+        self.payload = None
+        self.requests = {"status": [], "information": []}
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.endswith("station_information.json"):
+                    stub.requests["information"].append(time.monotonic())
+                    if self.headers.get("If-None-Match") == INFORMATION_ETAG:
+                        self.send_response(304)
+                        self.end_headers()
+                        return
+                    self.reply(200, stub.information, {"ETag": INFORMATION_ETAG})
+                    return
+
+                stub.requests["status"].append(time.monotonic())
+                time.sleep(stub.delay)
+                answer = stub.queue.pop(0) if stub.queue else stub.payload
+                if isinstance(answer, int):
+                    self.reply(answer, b"")
+                    return
+                stub.payload = answer
+                self.reply(200, json.dumps(answer).encode())
+
+            def reply(self, code, body, headers=None):
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, name="feeds-stub", daemon=True).start()
+        root = "http://127.0.0.1:{}/".format(self.server.server_port)
+        self.status_url, self.information_url = root + "station_status.json", root + "station_information.json"
+
+    def shutdown(self):
+        self.server.shutdown()
+
+
+def changed(payload, n_changed, stop_renting=0):
+    # Same poll where only the first n_changed stations reported again, the first stop_renting of them not renting
+    payload = copy.deepcopy(payload)
+    for i, station in enumerate(payload["data"]["stations"][:n_changed]):
+        station["last_reported"] += 60
+        if i < stop_renting:
+            station["is_renting"] = station["is_returning"] = 0
+    return payload
+
+
+def poll(collector):
+    # Polls are stored by the second
+    time.sleep(1)
+    return asyncio.run(collector.poll())
+
+
+def check_polls(stub, payload):
+    # Retries on server errors, then deduplication of unchanged and partly changed polls
+    collector = Collector(status_url=stub.status_url, information_url=stub.information_url, dedupe=True,
+                          information_ttl=0, backoff=0.01, max_retries=3)
+    n_stations = len(payload["data"]["stations"])
+
+    stub.queue = [503, 502, payload]
+    assert poll(collector) == n_stations
+    assert len(stub.requests["status"]) == 3, len(stub.requests["status"])
+    assert len(list_snapshots()) == 1
+
+    # Nothing reported since: no snapshot, the aggregates staying as they were
+    last_date = collector.state.last_date
+    assert poll(collector) == 0
+    assert len(list_snapshots()) == 1 and collector.state.last_date == last_date
+
+    stub.queue = [changed(payload, 10, stop_renting=3)]
+    assert poll(collector) == 10
+    assert len(list_snapshots()) == 2 and collector.state.last_date > last_date
+
+    # The only station that reported again stopped renting, which leaves no row to fold in
+    last_date = collector.state.last_date
+    stub.queue = [500, changed(stub.payload, 1, stop_renting=1)]
+    assert poll(collector) == 1
+    assert len(list_snapshots()) == 3 and collector.state.last_date > last_date
+    assert AggregateState.load().last_date == collector.state.last_date
+
+    # Given up after max_retries, nothing being written
+    stub.queue = [503] * 4
+    try:
+        poll(collector)
+        raise AssertionError("the poll did not fail")
+    except requests.HTTPError:
+        pass
+    assert len(list_snapshots()) == 3
+
+    # station_information was revalidated along with every poll, the later ones answered by a 304
+    assert len(stub.requests["information"]) == 5, len(stub.requests["information"])
+    collector.session.close()
+
+
+def check_cadence(stub, payload, period, n_polls):
+    # The polls start period seconds apart, however long each one takes
+    stub.queue = [changed(payload, k + 1) for k in range(n_polls)]
+    stub.requests["status"].clear()
+    collector = Collector(period=period, status_url=stub.status_url, information_url=stub.information_url,
+                          dedupe=True, backoff=0.01)
+    asyncio.run(collector.run(n_polls=n_polls))
+    starts = stub.requests["status"]
+    assert len(starts) == n_polls, len(starts)
+    for k, start in enumerate(starts):
+        assert abs(start - starts[0] - k * period) < 0.5, [x - starts[0] for x in starts]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the collector against a local stub of the feeds")
+    parser.add_argument("--stations", type=int, default=1500)
+    parser.add_argument("--period", type=float, default=MIN_PERIOD)
+    parser.add_argument("--cadence-polls", type=int, default=2)
+    parser.add_argument("--delay", type=float, default=1.0, help="Seconds each status answer takes")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    information = station_information_payload(args.stations)
+    _, payload = next(status_payloads(information, 1))
+    stub = StubServer(information)
+    cwd, workdir = os.getcwd(), tempfile.mkdtemp(prefix="velib-collector-")
+    try:
+        os.chdir(workdir)
+        start = time.perf_counter()
+        check_polls(stub, payload)
+        print("polls    {:.2f}s".format(time.perf_counter() - start))
+
+        shutil.rmtree(workdir)
+        os.makedirs(workdir)
+        os.chdir(workdir)
+        stub.delay = args.delay
+        start = time.perf_counter()
+        check_cadence(stub, payload, args.period, args.cadence_polls)
+        print("cadence  {:.2f}s".format(time.perf_counter() - start))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        stub.shutdown()
+    print("Collector checks passed")
@@ -0,0 +1,97 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import warnings
+from datetime import timedelta
+
+import pandas as pd
+
+from aggregates import AggregateState
+from api_calls import status_to_frame
+from data_process import preprocess, preprocess_incremental, preprocess_streaming
+from storage import write_snapshot
+from synthetic import poll_dates, station_information_payload, status_payloads, write_history
+
+SNAPSHOT_DIR = "snapshots"
+INFORMATION_PATH = "station_information.json"
+STATE_PATH = "aggregates.npz"
+EVENTS_PATH = "outage_events.csv"
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def in_memory():
+    return preprocess(SNAPSHOT_DIR, information_path=INFORMATION_PATH, events_path=EVENTS_PATH)[0]
+
+
+def streaming(chunk_polls):
+    return preprocess_streaming(SNAPSHOT_DIR, information_path=INFORMATION_PATH, chunk_polls=chunk_polls,
+                                events_path=EVENTS_PATH)
+
+
+def incremental():
+    return preprocess_incremental(SNAPSHOT_DIR, STATE_PATH, INFORMATION_PATH, EVENTS_PATH)
+
+
+def filtered_poll(information, date):
+    # Poll where no station is renting, e.g. all flagged closed, which leaves no row to fold in
+    _, data = next(status_payloads(information, 1, start=date))
+    for station in data["data"]["stations"]:
+        station["is_renting"] = 0
+    return status_to_frame(data, date)
+
+
+def check_filtered_poll(information, date):
+    # Folded in like the collector does, with the dates as strings
+    state = AggregateState()
+    assert state.update(filtered_poll(information, date)), "the poll is not counted"
+    assert state.last_date == pd.Timestamp(date), state.last_date
+    assert not state.counts.any()
+
+
+def bench(n_polls, n_stations, chunk_polls):
+    # The same table from the whole history in memory, streamed chunk by chunk and extended poll by poll
+    information = station_information_payload(n_stations)
+    first_polls = n_polls // 2
+    write_history(SNAPSHOT_DIR, information, first_polls, information_path=INFORMATION_PATH)
+    incremental()
+
+    start = poll_dates(first_polls + 1)[-1]
+    write_snapshot(filtered_poll(information, start), SNAPSHOT_DIR)
+    write_history(SNAPSHOT_DIR, information, n_polls - first_polls - 1, seed=1, start=start + timedelta(minutes=15))
+    check_filtered_poll(information, start)
+
+    reference, reference_time = timed(in_memory)
+    results = {"streaming": timed(streaming, chunk_polls), "incremental": timed(incremental)}
+    for name, (result, _) in results.items():
+        pd.testing.assert_frame_equal(result, reference, obj=name)
+    return reference_time, {name: elapsed for name, (_, elapsed) in results.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the streaming and incremental preprocessing return the "
+                                                 "table of the in-memory one")
+    parser.add_argument("--polls", type=int, default=200)
+    parser.add_argument("--stations", type=int, default=1500)
+    parser.add_argument("--chunk-polls", type=int, default=7)
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    cwd, workdir = os.getcwd(), tempfile.mkdtemp(prefix="velib-streaming-")
+    try:
+        os.chdir(workdir)
+        reference_time, times = bench(args.polls, args.stations, args.chunk_polls)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print("{} polls of {} stations  in memory {:.2f}s  {}".format(
+        args.polls, args.stations, reference_time,
+        "  ".join("{} {:.2f}s".format(name, elapsed) for name, elapsed in times.items())))
+    print("Same tables")
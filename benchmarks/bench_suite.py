@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from aggregates import AggregateState
+from api_calls import request_and_write
+from artifacts import Artifacts
+from build import build
+from data_process import clustering, preprocess, preprocess_streaming
+from forecasting import fit_forecasts
+from stations import INFORMATION_PATH
+from storage import SNAPSHOT_DIR
+from synthetic import station_information_payload, status_payloads, write_history
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# History of the 1x size, in polls every 15 minutes of N_STATIONS stations
+BASE_POLLS = 16
+N_STATIONS = 1500
+SCALES = [1, 10, 100]
+
+# A measure regresses when it is THRESHOLD times its baseline, and also above these absolute margins, so that the
+# noise of the callbacks taking a few milliseconds is not reported
+THRESHOLD = 1.5
+MIN_SECONDS = 0.05
+MIN_PEAK_MB = 1
+
+
+def measure(function, repeat=5):
+    # Best wall time over repeat runs, then the peak of the memory allocated during one more run
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {"seconds": min(times), "peak_mb": peak / 1e6}
+
+
+def serve_status(payload):
+    # Local stand-in for the station_status endpoint, so that request_and_write runs offline
+    body = json.dumps(payload).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, name="status-stub", daemon=True).start()
+    return server, "http://127.0.0.1:{}/station_status.json".format(server.server_port)
+
+
+def prepare(workdir, scale, base_polls=BASE_POLLS, n_stations=N_STATIONS):
+    # One workspace per size, reused when it already holds the history
+    directory = os.path.join(workdir, "{}x".format(scale))
+    if not os.path.exists(os.path.join(directory, "ready")):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        information = station_information_payload(n_stations)
+        write_history(os.path.join(directory, SNAPSHOT_DIR), information, scale * base_polls,
+                      information_path=os.path.join(directory, "station_information.json"))
+        open(os.path.join(directory, "ready"), "w").close()
+    return directory
+
+
+def live_benchmark(status_url, repeat, directory="live"):
+    # request_and_write keeps the outage detector and its events in the working directory, so the live polls are
+    # written to their own: the stations flagged there are not left out of the other benchmarks
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    shutil.copy(INFORMATION_PATH, directory)
+    state = AggregateState()
+    state.update_from_store(SNAPSHOT_DIR)
+    state.save(os.path.join(directory, "aggregates.npz"))
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        return measure(lambda: request_and_write(SNAPSHOT_DIR, "aggregates.npz", status_url), repeat)
+    finally:
+        os.chdir(cwd)
+
+
+def pipeline_benchmarks(status_url, repeat):
+    results = {}
+    results["request_and_write"] = live_benchmark(status_url, repeat)
+    results["preprocess"] = measure(lambda: preprocess(SNAPSHOT_DIR), repeat)
+    results["preprocess_streaming"] = measure(lambda: preprocess_streaming(SNAPSHOT_DIR), repeat)
+
+    _, df_geo = preprocess(SNAPSHOT_DIR)
+    results["clustering"] = measure(lambda: clustering(df_geo, model_path="bench_clustering.npz", refit=True),
+                                    repeat)
+    results["fit_forecasts"] = measure(lambda: fit_forecasts(df_geo, path="bench_forecasts.npz"), repeat)
+    results["build"] = measure(lambda: build(SNAPSHOT_DIR, "bench_artifacts"), repeat)
+    return results
+
+
+def callback_benchmarks(dash_app, repeat):
+    artifacts = dash_app.artifacts
+    station_id = int(artifacts.frame_slices.station_ids[0])
+    click = {"points": [{"customdata": [station_id, 0], "hovertext": "Station"}]}
+    y, size = "frac_ebikes", "num_bikes_available"
+    frame = len(artifacts.frame_slices) // 2
+    client = dash_app.server.test_client()
+
+    def main_figure(mode_plot, render_plot="Animation", cached=False):
+        if not cached:
+            dash_app.main_figure_cache.invalidate()
+            dash_app.compact_figure_cache.invalidate()
+        return dash_app.update_graph(False, mode_plot, y, size, render_plot, None, 0)
+
+    dash_app.main_figure_cache.get(False, "Scatter", y, size)
+    # The cached figure is measured first, before the others invalidate the cache
+    callbacks = {
+        "update_graph[cached]": lambda: main_figure("Scatter", cached=True),
+        "update_language": lambda: dash_app.update_language(False, None),
+        "update_graph[scatter]": lambda: main_figure("Scatter"),
+        "update_graph[density]": lambda: main_figure("Density"),
+        "update_graph[frames]": lambda: main_figure("Scatter", "Frames"),
+        "update_graph[compact]": lambda: main_figure("Scatter", "Compact"),
+        "update_graph[compact_density]": lambda: main_figure("Density", "Compact"),
+        "update_frame": lambda: dash_app.update_frame(frame, "Frames", False, "Scatter", y, size),
+        "show_time_controls": lambda: dash_app.show_time_controls("Frames"),
+        "toggle_play": lambda: dash_app.toggle_play(1),
+        "advance_frame": lambda: dash_app.advance_frame(1, frame),
+        "display_click_data": lambda: dash_app.display_click_data(False, click, None),
+        "display_nearby_stations": lambda: dash_app.display_nearby_stations(False, click, "num_ebikes_available",
+                                                                            None),
+        "nearest_api": lambda: client.get("/api/nearest?lat=48.86&lon=2.34&metric=docks"),
+        "display_station_forecast": lambda: dash_app.display_station_forecast(False, click, None),
+        "forecast_api": lambda: client.get("/api/forecast?station_id={}&horizon=60".format(station_id)),
+        "update_clustering_graph": lambda: dash_app.update_clustering_graph(False, None),
+        "display_click_data_clustering": lambda: dash_app.display_click_data_clustering(False, click),
+        "check_data_version": lambda: dash_app.check_data_version(1, None),
+    }
+    return {name: measure(callback, repeat) for name, callback in callbacks.items()}
+
+
+def run(workdir, scales=SCALES, base_polls=BASE_POLLS, n_stations=N_STATIONS, repeat=5):
+    information = station_information_payload(n_stations)
+    _, payload = next(status_payloads(information, 1))
+    server, status_url = serve_status(payload)
+    cwd = os.getcwd()
+    dash_app = None
+    results = {}
+    try:
+        for scale in scales:
+            os.chdir(prepare(workdir, scale, base_polls, n_stations))
+            print("{}x: {} polls of {} stations".format(scale, scale * base_polls, n_stations))
+
+            for name, result in pipeline_benchmarks(status_url, repeat).items():
+                results["{}@{}x".format(name, scale)] = result
+
+            if dash_app is None:
+                # The app builds the artifacts of the first workspace when it is imported
+                import dash_app
+                dash_app.refresher.stop()
+            dash_app.artifacts = Artifacts(build(SNAPSHOT_DIR))
+            dash_app.nearby.refresh()
+            dash_app.main_figure_cache.invalidate()
+            dash_app.compact_figure_cache.invalidate()
+            for name, result in callback_benchmarks(dash_app, repeat).items():
+                results["{}@{}x".format(name, scale)] = result
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+    return results
+
+
+def compare(results, baselines, threshold=THRESHOLD):
+    regressions = []
+    print("{:<40} {:>10} {:>10} {:>10} {:>10}".format("benchmark", "seconds", "baseline", "peak MB", "baseline"))
+    for key, result in results.items():
+        baseline = baselines.get(key, {})
+        print("{:<40} {:>10.4f} {:>10} {:>10.1f} {:>10}".format(
+            key, result["seconds"], "{:.4f}".format(baseline["seconds"]) if baseline else "-",
+            result["peak_mb"], "{:.1f}".format(baseline["peak_mb"]) if baseline else "-"))
+        for metric, margin in [("seconds", MIN_SECONDS), ("peak_mb", MIN_PEAK_MB)]:
+            if not baseline:
+                continue
+            if result[metric] > threshold * baseline[metric] and result[metric] - baseline[metric] > margin:
+                regressions.append("{} {}: {:.4g} vs {:.4g}".format(key, metric, result[metric], baseline[metric]))
+    return regressions
+
+
+def load_baselines(path=BASELINES_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time and memory-profile the pipeline and the Dash callbacks on "
+                                                 "synthetic histories, against the stored baselines")
+    parser.add_argument("--scales", type=int, nargs="+", default=SCALES)
+    parser.add_argument("--base-polls", type=int, default=BASE_POLLS, help="Polls of the 1x history")
+    parser.add_argument("--stations", type=int, default=N_STATIONS)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--workdir", default=None, help="Keep the generated histories there to reuse them")
+    parser.add_argument("--baselines", default=BASELINES_PATH)
+    parser.add_argument("--update-baselines", action="store_true",
+                        help="Store the results as the new baselines, which only make sense on the same machine")
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="velib-bench-")
+    try:
+        results = run(workdir, args.scales, args.base_polls, args.stations, args.repeat)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baselines = load_baselines(args.baselines)
+    regressions = compare(results, baselines, args.threshold)
+    if args.update_baselines:
+        baselines.update(results)
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print("Baselines written to {}".format(args.baselines))
+    elif regressions:
+        print("Regressions over x{}:\n{}".format(args.threshold, "\n".join(regressions)))
+        sys.exit(1)
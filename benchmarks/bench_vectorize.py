@@ -0,0 +1,104 @@
+import argparse
+import locale
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from api_calls import status_to_frame
+from data_process import add_time_columns
+from synthetic import station_information_payload, status_payloads
+
+
+# Row-wise implementations kept as the reference for the vectorized ones
+def status_to_frame_apply(data, date_retrieved):
+    df = pd.DataFrame(data["data"]["stations"])
+    df["num_mech_bikes_available"] = df.num_bikes_available_types.apply(lambda x: x[0]["mechanical"])
+    df["num_ebikes_available"] = df.num_bikes_available_types.apply(lambda x: x[1]["ebike"])
+    df["legible_last_reported"] = df.last_reported.apply(datetime.fromtimestamp)
+    df["functioning_word"] = df.is_installed.apply(str) + df.is_returning.apply(str) + df.is_renting.apply(str)
+    df = df.drop(["numBikesAvailable", "numDocksAvailable", "num_bikes_available_types"], axis=1)
+    df["lastUpdated"] = datetime.fromtimestamp(data["lastUpdatedOther"])
+    df["date_retrieved"] = date_retrieved.strftime("%Y-%m-%d %H:%M:%S")
+    return df
+
+
+def add_time_columns_apply(df):
+    df["day_hour_of_week_num"] = df["date_retrieved"].apply(lambda x: 100 * x.weekday() + x.hour)
+    df["hour_num"] = df["date_retrieved"].apply(lambda x: x.hour)
+
+    labels_fr = strftime_apply(df["date_retrieved"], "%A %Hh", "fr_FR")
+    if labels_fr is not None:
+        df["Jour et heure"] = labels_fr
+    df["Time"] = strftime_apply(df["date_retrieved"], "%A %I%p", "en_US", c_equivalent=True)
+    return df
+
+
+def strftime_apply(dates, date_format, locale_name, c_equivalent=False):
+    # None without the locale, unless the C one formats date_format as it does, e.g. %A and %p as en_US
+    try:
+        locale.setlocale(locale.LC_TIME, locale_name)
+    except locale.Error:
+        if not c_equivalent:
+            return None
+        print("No {} locale on this host, using the C one".format(locale_name))
+        locale.setlocale(locale.LC_TIME, "C")
+    return dates.apply(lambda x: datetime.strftime(x, date_format))
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def assert_same(df, reference):
+    assert list(df.columns) == list(reference.columns), (list(df.columns), list(reference.columns))
+    for column in df.columns:
+        values, expected = df[column], reference[column]
+        if expected.dtype == object and not isinstance(expected.iloc[0], str):
+            expected = pd.to_datetime(expected)
+        if values.dtype.kind in "iuf":
+            assert np.array_equal(values.to_numpy(), expected.to_numpy()), column
+        else:
+            assert (values.astype(str).to_numpy() == expected.astype(str).to_numpy()).all(), column
+
+
+def bench_status(n_rows, n_stations=1500):
+    # One payload per poll, as request_and_write receives them
+    information = station_information_payload(n_stations)
+    reference_time, result_time = 0, 0
+    for date, data in status_payloads(information, n_rows // n_stations):
+        reference, elapsed = timed(status_to_frame_apply, data, date)
+        reference_time += elapsed
+        result, elapsed = timed(status_to_frame, data, date)
+        result_time += elapsed
+        assert_same(result, reference)
+    return reference_time, result_time
+
+
+def bench_time_columns(n_rows, n_stations=1500):
+    # Polls every 15 minutes, each one repeated for every station
+    dates = pd.date_range("2021-09-06 00:07:12", periods=n_rows // n_stations + 1, freq="15min")
+    df = pd.DataFrame({"date_retrieved": np.repeat(dates.to_numpy(), n_stations)[:n_rows]})
+
+    reference, reference_time = timed(add_time_columns_apply, df.copy())
+    result, result_time = timed(add_time_columns, df.copy())
+    if "Jour et heure" not in reference:
+        # Any other reference would be a copy of labels.py
+        print("No fr_FR locale on this host, the Jour et heure labels are not checked")
+        result = result.drop(columns="Jour et heure")
+    assert_same(result, reference)
+    return reference_time, result_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the row-wise and vectorized transformations")
+    parser.add_argument("--rows", type=int, default=3 * 10 ** 6)
+    args = parser.parse_args()
+
+    for name, (reference_time, result_time) in [("status_to_frame", bench_status(args.rows)),
+                                                 ("add_time_columns", bench_time_columns(args.rows))]:
+        print("{:<20} {:>9} rows  apply {:8.2f}s  vectorized {:8.2f}s  x{:.0f}".format(
+            name, args.rows, reference_time, result_time, reference_time / result_time))
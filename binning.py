@@ -0,0 +1,95 @@
+import numpy as np
+
+EARTH_RADIUS = 6371000.
+# Circumradius of the cells in meters, a few hundred cells over the stations of Paris
+HEX_RADIUS = 600
+
+# Counts and differences are summed over the stations of a cell, rates and fractions are averaged
+MEAN_PREFIXES = ("occupancy", "frac")
+
+
+def _hex_round(q, r):
+    # Nearest hexagon of fractional axial coordinates, by rounding in cube coordinates
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(int), rr.astype(int)
+
+
+class HexGrid:
+    # Pointy-top hexagonal cells over the stations, in a flat projection around their center. Only the cells holding
+    # a station are kept, and the aggregates of a metric are computed for all the frames at once and then kept.
+
+    def __init__(self, frame_slices, radius=HEX_RADIUS):
+        self.frame_slices = frame_slices
+        self.radius = radius
+        self.lat0, self.lon0 = float(np.mean(frame_slices.lat)), float(np.mean(frame_slices.lon))
+
+        x, y = self._project(frame_slices.lat, frame_slices.lon)
+        q, r = _hex_round((np.sqrt(3) / 3 * x - y / 3) / radius, 2 / 3 * y / radius)
+        cells, self.cell_of_station = np.unique(np.column_stack([q, r]), axis=0, return_inverse=True)
+        self.cell_of_station = self.cell_of_station.ravel()
+        self.q, self.r = cells[:, 0], cells[:, 1]
+        self.counts = np.bincount(self.cell_of_station, minlength=len(self))
+
+        # The biggest station of a cell stands for it in the hover and on click
+        order = np.lexsort((-frame_slices.capacity.astype(float), self.cell_of_station))
+        self.representative = order[np.searchsorted(self.cell_of_station[order], np.arange(len(self)))]
+        self.station_ids = frame_slices.station_ids[self.representative]
+        self.names = frame_slices.names[self.representative]
+
+        self.membership = np.zeros((len(frame_slices.station_ids), len(self)), dtype="float32")
+        self.membership[np.arange(len(frame_slices.station_ids)), self.cell_of_station] = 1
+        self.geojson = self._geojson()
+        self._aggregates = {}
+
+    def __len__(self):
+        return len(self.q)
+
+    def _project(self, lat, lon):
+        x = np.radians(np.asarray(lon, dtype=float) - self.lon0) * EARTH_RADIUS * np.cos(np.radians(self.lat0))
+        y = np.radians(np.asarray(lat, dtype=float) - self.lat0) * EARTH_RADIUS
+        return x, y
+
+    def _unproject(self, x, y):
+        lat = self.lat0 + np.degrees(y / EARTH_RADIUS)
+        lon = self.lon0 + np.degrees(x / (EARTH_RADIUS * np.cos(np.radians(self.lat0))))
+        return lat, lon
+
+    def _geojson(self):
+        center_x = self.radius * np.sqrt(3) * (self.q + self.r / 2)
+        center_y = self.radius * 1.5 * self.r
+        angles = np.radians(30 + 60 * np.arange(7))
+        lat, lon = self._unproject(center_x[:, None] + self.radius * np.cos(angles),
+                                   center_y[:, None] + self.radius * np.sin(angles))
+        lat, lon = np.round(lat, 5), np.round(lon, 5)
+        return {"type": "FeatureCollection",
+                "features": [{"type": "Feature", "id": cell,
+                              "geometry": {"type": "Polygon", "coordinates": [np.column_stack([lon[cell],
+                                                                                               lat[cell]]).tolist()]}}
+                             for cell in range(len(self))]}
+
+    def aggregates(self, metric):
+        # (frame, cell) sums or means of the stations reporting in the frame, NaN for the cells without any
+        if metric not in self._aggregates:
+            values = self.frame_slices.values[metric]
+            valid = ~np.isnan(values)
+            sums = np.where(valid, values, 0) @ self.membership
+            counts = valid.astype("float32") @ self.membership
+            with np.errstate(invalid="ignore", divide="ignore"):
+                cells = sums / counts if metric.startswith(MEAN_PREFIXES) else np.where(counts > 0, sums, np.nan)
+            self._aggregates[metric] = cells.astype("float32")
+        return self._aggregates[metric]
+
+    def frame(self, metric, frame):
+        return self.aggregates(metric)[frame]
+
+    def range(self, metric):
+        cells = self.aggregates(metric)
+        if not cells.size or np.isnan(cells).all():
+            return 0., 0.
+        return min(float(np.nanmin(cells)), 0.), float(np.nanmax(cells))
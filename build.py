@@ -0,0 +1,111 @@
+import argparse
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from aggregates import AGGREGATES_PATH, AggregateState
+from artifacts import ARTIFACTS_DIR, HISTORY_COLUMN, build_lock, current_version, publish, write_frame
+from cluster_model import MAX_AGE
+from data_process import clustering, preprocess, preprocess_incremental
+from downsample import Rollups
+from forecasting import fit_forecasts
+from metrics import timed
+from outages import Exclusions
+from stations import load_stations
+from storage import SNAPSHOT_DIR, read_snapshots
+
+
+def write_version(artifacts_dir, group_by_geo_df, cluster_df, cluster_centers, rollups, date_last_updated):
+    version_dir = os.path.join(artifacts_dir, datetime.now().strftime("%Y%m%dT%H%M%S%f"))
+    write_frame(group_by_geo_df.reset_index(drop=True), os.path.join(version_dir, "timeslice"))
+    write_frame(cluster_df.reset_index(drop=True), os.path.join(version_dir, "clusters"))
+    np.save(os.path.join(version_dir, "cluster_centers.npy"), cluster_centers)
+    rollups.save(os.path.join(version_dir, "rollups"))
+
+    with open(os.path.join(version_dir, "meta.json"), "w") as f:
+        json.dump({"date_last_updated": date_last_updated.isoformat(),
+                   "built_at": datetime.now().isoformat()}, f)
+
+    publish(version_dir, artifacts_dir)
+    return version_dir
+
+
+@timed("build")
+def build(snapshot_dir=SNAPSHOT_DIR, artifacts_dir=ARTIFACTS_DIR, refit=False, report=False,
+          state_path=AGGREGATES_PATH):
+    # Everything the dashboard needs is computed once here, the Dash workers only map the result
+    group_by_geo_df, df_geo = preprocess(snapshot_dir, report=report)
+    # The aggregates then extended by the collector and the incremental builds start from the same polls
+    state = AggregateState()
+    state.update_from_store(snapshot_dir, exclusions=Exclusions.load())
+    state.save(state_path)
+    cluster_df, cluster_centers = clustering(df_geo, refit=refit, max_age=MAX_AGE)
+    # The forecasts are then refreshed by the poller after each poll
+    fit_forecasts(df_geo)
+    rollups = Rollups.from_frame(df_geo, HISTORY_COLUMN)
+    return write_version(artifacts_dir, group_by_geo_df, cluster_df, cluster_centers, rollups,
+                         pd.Timestamp(int(df_geo.date_retrieved.max()), unit="s"))
+
+
+@timed("build_incremental")
+def build_incremental(snapshot_dir=SNAPSHOT_DIR, artifacts_dir=ARTIFACTS_DIR, state_path=AGGREGATES_PATH,
+                      full_fallback=True):
+    # Only the polls written since the published version are read: the weekday-hour table comes from the
+    # persisted aggregates and the history rollups of the published version are extended. Without a version to
+    # extend, everything is built again unless full_fallback is False, e.g. in the web workers, which leave that to
+    # build.py. Returns None when there is nothing new or nothing was built.
+    version_dir = current_version(artifacts_dir)
+    if version_dir is None:
+        if not full_fallback:
+            print("No published version to extend, run build.py")
+            return None
+        return build(snapshot_dir, artifacts_dir)
+
+    rollups = Rollups.load(os.path.join(version_dir, "rollups"), HISTORY_COLUMN)
+    start = rollups.last_date + pd.Timedelta(seconds=1) if rollups.last_date is not None else None
+    new_polls = read_snapshots(snapshot_dir, start=start,
+                               columns=["station_id", "date_retrieved", "is_renting", HISTORY_COLUMN])
+    if new_polls.empty:
+        return None
+    # Same rows as the history of preprocess
+    excluded = Exclusions.load().mask(new_polls.station_id.to_numpy(), new_polls.date_retrieved.to_numpy())
+    new_polls = new_polls[(new_polls.is_renting == 1).to_numpy() & ~excluded
+                          & new_polls.station_id.isin(load_stations().index).to_numpy()]
+
+    group_by_geo_df = preprocess_incremental(snapshot_dir, state_path)
+    # The aggregates are only extended when they hold the polls of the published version
+    state = AggregateState.load(state_path)
+    if rollups.first_date is not None and not state.covers(rollups.first_date, rollups.last_date):
+        if not full_fallback:
+            print("{} does not cover the published version, run build.py".format(state_path))
+            return None
+        print("{} does not cover the published version, building it again".format(state_path))
+        return build(snapshot_dir, artifacts_dir, state_path=state_path)
+
+    # The table already holds the mean per station and weekday-hour, which is what the clustering profiles are. The
+    # clustering is refitted once MAX_AGE old.
+    cluster_df, cluster_centers = clustering(group_by_geo_df, max_age=MAX_AGE)
+    rollups = rollups.extend(new_polls.station_id.to_numpy(), new_polls.date_retrieved.to_numpy(),
+                             new_polls[HISTORY_COLUMN].to_numpy())
+    return write_version(artifacts_dir, group_by_geo_df, cluster_df, cluster_centers, rollups, state.last_date)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the artifacts served by the dashboard")
+    parser.add_argument("--snapshot-dir", default=SNAPSHOT_DIR)
+    parser.add_argument("--artifacts-dir", default=ARTIFACTS_DIR)
+    parser.add_argument("--refit", action="store_true", help="Refit the clustering instead of reusing the model")
+    parser.add_argument("--memory-report", action="store_true", help="Print the memory of the history frame")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only fold the polls written since the published version into it")
+    args = parser.parse_args()
+
+    with build_lock(args.artifacts_dir):
+        if args.incremental:
+            version_dir = build_incremental(args.snapshot_dir, args.artifacts_dir)
+        else:
+            version_dir = build(args.snapshot_dir, args.artifacts_dir, args.refit, args.memory_report)
+    print("Artifacts written to {}".format(version_dir) if version_dir else "No new polls")
@@ -0,0 +1,83 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+CLUSTERING_PATH = "clustering.npz"
+
+# Seconds after which the builds refit the clustering, warm-started from the current centers
+MAX_AGE = float(os.environ.get("VELIB_CLUSTERING_MAX_AGE", 7 * 24 * 60 * 60))
+
+
+class ClusterModel:
+    # Fitted cluster centers over the weekday-hour slots in observed, for profiles normalized by their maximum, and
+    # the labels of the stations of the fit. Those keep their label and new stations are assigned to the nearest
+    # center, so that new data does not need a refit.
+
+    def __init__(self, centers, observed, algorithm, fitted_at=None, station_ids=None, labels=None):
+        self.centers = centers
+        self.observed = observed
+        self.algorithm = algorithm
+        self.fitted_at = time.time() if fitted_at is None else fitted_at
+        self.station_ids = np.zeros(0, dtype="int64") if station_ids is None else station_ids
+        self.labels = np.zeros(0, dtype="int64") if labels is None else labels
+
+    @property
+    def n_clusters(self):
+        return len(self.centers)
+
+    @property
+    def age(self):
+        return time.time() - self.fitted_at
+
+    def assign(self, dataset):
+        # Nearest center under the distance the model was fitted with
+        profiles = dataset[:, self.observed]
+        if self.algorithm in ("softdtw", "dtw"):
+            try:
+                from tslearn.metrics import cdist_dtw, cdist_soft_dtw
+            except ImportError:
+                raise ImportError("The {} clustering needs tslearn, install it with pip install tslearn".format(
+                    self.algorithm))
+            cdist = cdist_dtw if self.algorithm == "dtw" else cdist_soft_dtw
+            distances = cdist(profiles[:, :, None], self.centers[:, :, None])
+        else:
+            distances = ((profiles[:, None] - self.centers[None]) ** 2).sum(axis=2)
+        return distances.argmin(axis=1)
+
+    def assign_stations(self, station_ids, dataset):
+        # Saved label of the stations of the fit, nearest center for the others
+        positions = pd.Index(self.station_ids).get_indexer(station_ids)
+        known = positions >= 0
+        labels = np.empty(len(station_ids), dtype="int64")
+        labels[known] = self.labels[positions[known]]
+        if not known.all():
+            labels[~known] = self.assign(dataset[~known])
+        return labels
+
+    def save(self, path=CLUSTERING_PATH):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, centers=self.centers, observed=self.observed, algorithm=np.array(self.algorithm),
+                     fitted_at=np.array(self.fitted_at), station_ids=self.station_ids, labels=self.labels)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=CLUSTERING_PATH):
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            # Models saved without the labels assign every station
+            assignments = [data[name] if name in data.files else None for name in ("station_ids", "labels")]
+            return cls(data["centers"], data["observed"], str(data["algorithm"]), float(data["fitted_at"]),
+                       *assignments)
+
+
+def stable_order(centers):
+    # Clusters are numbered by the mean of their center, so that a refit from scratch keeps the same numbering
+    # (and colors) as long as the clusters themselves do not change
+    order = np.argsort(centers.mean(axis=1), kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return order, rank
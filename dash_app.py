@@ -1,16 +1,26 @@
-import locale
+import os
 
 import dash
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
-from dash.dependencies import Input, Output
-
-from data_process import preprocess, clustering
+from dash import Patch, callback_context, html, no_update
+from dash.dependencies import Input, Output, State
+
+from artifacts import build_lock, current_version, load_artifacts
+from build import build
+from refresher import REFRESH_PERIOD, Refresher
+from figure_cache import FigureCache
+from forecasting import HORIZONS, ForecastReader, register as register_forecasts
+from frames import encode
+from labels import format_last_updated
 from layout import LAYOUT
+from metrics import register as register_metrics, timed, timed_callback
+from nearby import NearbyStations, register as register_nearby
 
-NAME_CSV = "velib_data_with_date.csv"
+# Per cache and per worker, each gunicorn worker holding its own figures
+MAIN_FIGURE_CACHE_BYTES = 64 * 2 ** 20
 
 # Aggregate by timeframe and stations
 metrics = ['num_bikes_available',
@@ -52,9 +62,18 @@ pretty_names_FR = {'num_bikes_available': 'Nombre de vélos disponibles',
                    'diff_mech_bikes': 'Différence par pas de temps (seulement mécanique)',
                    }
 
-group_by_geo_timeslice_df, df_geo = preprocess(NAME_CSV)
-cluster_df, cluster_centers = clustering(df_geo)
-date_last_updated = df_geo.date_retrieved.max()
+# The aggregates are computed offline by build.py, the workers only map the published artifacts. Without any, the
+# first worker to take the lock builds them and the others wait for it.
+with build_lock():
+    if current_version() is None:
+        build()
+# The refresher swaps in newer versions by rebinding this global, so every callback reads it once and then works on
+# that single consistent version
+artifacts = load_artifacts()
+# Closest stations by the counts of the latest poll, refreshed along with the artifacts
+nearby = NearbyStations()
+# Availability forecasts, refreshed by the poller after each poll
+forecasts = ForecastReader()
 
 # Theme
 
@@ -69,6 +88,9 @@ color_theme = {
 
 app = dash.Dash(name=__name__, title="Manon's Velib")
 server = app.server
+register_metrics(server)
+register_nearby(server, nearby)
+register_forecasts(server, forecasts)
 
 app.layout = LAYOUT
 
@@ -80,8 +102,18 @@ app.layout = LAYOUT
     Output('size-label', 'children'),
     Output('metrics-label', 'children'),
     Output('last-updated', 'children'),
-    Input('in_french', 'value'))
-def update_language(in_french):
+    Output('render-plot', 'options'),
+    Output('render-label', 'children'),
+    Output('time-slider', 'max'),
+    Output('time-slider', 'marks'),
+    Output('nearby-metric', 'options'),
+    Output('nearby-label', 'children'),
+    Input('in_french', 'value'),
+    Input('data-version', 'data'))
+@timed_callback
+def update_language(in_french, data_version):
+    served = artifacts
+    frame_slices = served.frame_slices
     if in_french:
         options_y = [{"label": pretty_names_FR[x], "value": x} for x in metrics]
         options_mode = [
@@ -90,9 +122,18 @@ def update_language(in_french):
         ]
         size_label = "Rayon"
         metrics_label = "Couleur"
-        locale.setlocale(locale.LC_TIME, "fr_FR")
-        last_updated_text = "Dernière mise à jour : {} à {}".format(date_last_updated.strftime("%d %B %Y"),
-                                                                    date_last_updated.strftime("%Hh%M"))
+        options_render = [
+            {'label': 'Animation', 'value': 'Animation'},
+            {'label': 'Animation (compacte)', 'value': 'Compact'},
+            {'label': 'Image par image', 'value': 'Frames'}
+        ]
+        render_label = "Rendu"
+        options_nearby = [
+            {'label': 'Vélos', 'value': 'num_bikes_available'},
+            {'label': 'Vélos électriques', 'value': 'num_ebikes_available'},
+            {'label': 'Places libres', 'value': 'num_docks_available'}
+        ]
+        nearby_label = "Stations les plus proches avec des"
     else:
         options_y = [{"label": pretty_names_EN[x], "value": x} for x in metrics]
         options_mode = [
@@ -101,21 +142,31 @@ def update_language(in_french):
         ]
         size_label = "Radius"
         metrics_label = "Color"
-        locale.setlocale(locale.LC_TIME, "en_US")
-        last_updated_text = "Last updated : {} at {}".format(date_last_updated.strftime("%B %d, %Y"),
-                                                             date_last_updated.strftime("%H:%M"))
-    return options_y, options_y, options_mode, size_label, metrics_label, last_updated_text
+        options_render = [
+            {'label': 'Animation', 'value': 'Animation'},
+            {'label': 'Animation (compact)', 'value': 'Compact'},
+            {'label': 'Frame by frame', 'value': 'Frames'}
+        ]
+        render_label = "Rendering"
+        options_nearby = [
+            {'label': 'Bikes', 'value': 'num_bikes_available'},
+            {'label': 'Electrical bikes', 'value': 'num_ebikes_available'},
+            {'label': 'Free docks', 'value': 'num_docks_available'}
+        ]
+        nearby_label = "Closest stations with available"
+    last_updated_text = format_last_updated(served.date_last_updated, in_french)
 
+    # One mark per day on the time slider
+    marks = {i: label.split(" ")[0] for i, (label, day_hour) in
+             enumerate(zip(frame_slices.labels(in_french), frame_slices.day_hours)) if day_hour % 100 == 0}
+    return (options_y, options_y, options_mode, size_label, metrics_label, last_updated_text, options_render,
+            render_label, max(len(frame_slices) - 1, 0), marks, options_nearby, nearby_label)
 
-@app.callback(
-    Output('main-graphic', 'figure'),
-    Input('in_french', 'value'),
-    Input('mode-plot', 'value'),
-    Input('yaxis-column', 'value'),
-    Input('size-column', 'value'))
-def update_graph(in_french, mode_plot, yaxis_column_name, size_column_name):
-    rescale_size = np.abs(group_by_geo_timeslice_df[size_column_name])
-    rescale_size = (rescale_size - rescale_size.min()) / (rescale_size.max() - rescale_size.min())
+
+@timed("main_figure")
+def build_main_figure(in_french, mode_plot, yaxis_column_name, size_column_name):
+    # The density map is binned server side, see build_compact_figure
+    group_by_geo_timeslice_df = artifacts.group_by_geo_timeslice_df
     if in_french:
         local_day_hour = "Jour et heure"
         labels = pretty_names_FR
@@ -126,22 +177,13 @@ def update_graph(in_french, mode_plot, yaxis_column_name, size_column_name):
     # FIXME
     # local_day_hour = TIME_VARIABLE
 
-    if mode_plot == "Density":
-        rescale_size += 1
-        rescale_size *= 6
-        fig = px.density_mapbox(group_by_geo_timeslice_df, lat="lat", lon="lon", z=yaxis_column_name,
-                                radius=rescale_size,
-                                hover_name="name", hover_data=["num_bikes_available", "capacity"],
-                                zoom=10, range_color=[0, group_by_geo_timeslice_df[yaxis_column_name].max()],
-                                labels=labels, color_continuous_scale=color_theme["continuous_scale"],
-                                animation_frame=local_day_hour, animation_group="name")
-    else:
-        fig = px.scatter_mapbox(group_by_geo_timeslice_df, lat="lat", lon="lon", color=yaxis_column_name,
-                                size=size_column_name,
-                                hover_name="name", hover_data=["num_bikes_available", "capacity"],
-                                zoom=10, range_color=[0, group_by_geo_timeslice_df[yaxis_column_name].max()],
-                                labels=labels, color_continuous_scale=color_theme["continuous_scale"],
-                                animation_frame=local_day_hour, animation_group="name")  # , width=800, height=800)
+    fig = px.scatter_mapbox(group_by_geo_timeslice_df, lat="lat", lon="lon", color=yaxis_column_name,
+                            size=size_column_name,
+                            hover_name="name", hover_data=["num_bikes_available", "capacity"],
+                            custom_data=["station_id"],
+                            zoom=10, range_color=[0, group_by_geo_timeslice_df[yaxis_column_name].max()],
+                            labels=labels, color_continuous_scale=color_theme["continuous_scale"],
+                            animation_frame=local_day_hour, animation_group="name")  # , width=800, height=800)
 
     fig.update_layout(clickmode='event+select')
     fig.update_layout(mapbox_style="carto-positron")
@@ -156,14 +198,195 @@ def update_graph(in_french, mode_plot, yaxis_column_name, size_column_name):
     return fig
 
 
+@timed("frame_figure")
+def build_frame_figure(in_french, mode_plot, yaxis_column_name, size_column_name, frame):
+    # Only the values of a single frame are sent, later frames being patched in by update_frame
+    labels = pretty_names_FR if in_french else pretty_names_EN
+    served = artifacts
+    frame_slices = served.frame_slices
+    frame = min(frame or 0, len(frame_slices) - 1)
+
+    if mode_plot == "Density":
+        # Hexagonal cells aggregating their stations, a click opening the biggest one
+        hex_grid = served.hex_grid
+        zmin, zmax = hex_grid.range(yaxis_column_name)
+        fig = go.Figure(go.Choroplethmapbox(geojson=hex_grid.geojson, locations=np.arange(len(hex_grid)),
+                                            z=hex_grid.frame(yaxis_column_name, frame), zmin=zmin, zmax=zmax,
+                                            colorscale=color_theme["continuous_scale"],
+                                            colorbar={"title": labels[yaxis_column_name]},
+                                            marker={"opacity": 0.7, "line": {"width": 0}},
+                                            hovertext=hex_grid.names,
+                                            customdata=np.column_stack([hex_grid.station_ids, hex_grid.counts]),
+                                            hovertemplate="<b>%{hovertext}</b><br>" + labels[yaxis_column_name]
+                                                          + "=%{z}<br>stations=%{customdata[1]}<extra></extra>"))
+    else:
+        # Same scaling of the marker areas as px.scatter_mapbox
+        size_max = 20
+        sizeref = 2. * frame_slices.abs_max[size_column_name] / size_max ** 2 or 1
+        fig = go.Figure(go.Scattermapbox(lat=frame_slices.lat, lon=frame_slices.lon, mode="markers",
+                                         marker={"color": frame_slices.frame(yaxis_column_name, frame),
+                                                 "size": frame_slices.sizes(size_column_name, frame),
+                                                 "sizemode": "area", "sizeref": sizeref,
+                                                 "cmin": 0, "cmax": frame_slices.max[yaxis_column_name],
+                                                 "colorscale": color_theme["continuous_scale"],
+                                                 "colorbar": {"title": labels[yaxis_column_name]}},
+                                         hovertext=frame_slices.names,
+                                         customdata=np.column_stack([frame_slices.station_ids,
+                                                                     frame_slices.capacity]),
+                                         hovertemplate="<b>%{hovertext}</b><br>" + labels[yaxis_column_name]
+                                                       + "=%{marker.color}<br>capacity=%{customdata[1]}"
+                                                         "<extra></extra>"))
+
+    fig.update_layout(mapbox={"style": "carto-positron", "zoom": 10,
+                              "center": {"lat": np.mean(frame_slices.lat), "lon": np.mean(frame_slices.lon)}})
+    fig.update_layout(clickmode='event+select', uirevision=True)
+    fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0})
+    fig.add_annotation(text=frame_slices.labels(in_french)[frame], xref="paper", yref="paper", x=0.01, y=0.99,
+                       showarrow=False, font={"size": 18})
+
+    fig.update_layout(
+        font_family="Trebuchet MS",
+        font_color=color_theme["text"],
+        paper_bgcolor=color_theme["bg"],
+    )
+
+    return fig
+
+
+@timed("compact_figure")
+def build_compact_figure(in_french, mode_plot, yaxis_column_name, size_column_name):
+    # Same animation as build_main_figure, but positions, names and hover data are only in the trace and the frames
+    # only hold the values of each weekday-hour, as float32 binary arrays when the plotly.js served supports them
+    served = artifacts
+    frame_slices = served.frame_slices
+    fig = build_frame_figure(in_french, mode_plot, yaxis_column_name, size_column_name, 0).to_plotly_json()
+    fig["layout"].pop("annotations")
+    trace = fig["data"][0]
+    if mode_plot != "Density":
+        trace["lat"], trace["lon"] = encode(frame_slices.lat, 5), encode(frame_slices.lon, 5)
+
+    def frame_values(frame):
+        if mode_plot == "Density":
+            return {"z": encode(served.hex_grid.frame(yaxis_column_name, frame))}
+        return {"marker": {"color": encode(frame_slices.frame(yaxis_column_name, frame)),
+                           "size": encode(frame_slices.sizes(size_column_name, frame))}}
+
+    frames = [{"name": label, "data": [frame_values(frame)], "traces": [0]}
+              for frame, label in enumerate(frame_slices.labels(in_french))]
+    if mode_plot == "Density":
+        trace.update(frames[0]["data"][0])
+    else:
+        trace["marker"].update(frames[0]["data"][0]["marker"])
+    fig["frames"] = frames
+
+    # Play and pause buttons and slider of plotly express
+    animate = {"frame": {"duration": 500, "redraw": True}, "mode": "immediate", "fromcurrent": True,
+               "transition": {"duration": 0}}
+    fig["layout"]["updatemenus"] = [{
+        "type": "buttons", "direction": "left", "showactive": False, "pad": {"r": 10, "t": 70},
+        "x": 0.1, "xanchor": "right", "y": 0, "yanchor": "top",
+        "buttons": [{"label": "&#9654;", "method": "animate", "args": [None, animate]},
+                    {"label": "&#9724;", "method": "animate",
+                     "args": [[None], dict(animate, frame={"duration": 0, "redraw": True})]}]}]
+    fig["layout"]["sliders"] = [{
+        "active": 0, "len": 0.9, "pad": {"b": 10, "t": 60}, "x": 0.1, "xanchor": "left", "y": 0, "yanchor": "top",
+        "currentvalue": {"prefix": "{}=".format("Jour et heure" if in_french else "Time")},
+        "steps": [{"label": frame["name"], "method": "animate",
+                   "args": [[frame["name"]], dict(animate, frame={"duration": 0, "redraw": True})]}
+                  for frame in frames]}]
+    return fig
+
+
+# Figures of the main map only depend on these 4 inputs, so they are built once and then served from memory
+main_figure_cache = FigureCache(build_main_figure, max_bytes=MAIN_FIGURE_CACHE_BYTES)
+compact_figure_cache = FigureCache(build_compact_figure, max_bytes=MAIN_FIGURE_CACHE_BYTES)
+
+
+@app.callback(
+    Output('main-graphic', 'figure'),
+    Input('in_french', 'value'),
+    Input('mode-plot', 'value'),
+    Input('yaxis-column', 'value'),
+    Input('size-column', 'value'),
+    Input('render-plot', 'value'),
+    Input('data-version', 'data'),
+    State('time-slider', 'value'))
+@timed_callback
+def update_graph(in_french, mode_plot, yaxis_column_name, size_column_name, render_plot, data_version, frame):
+    if render_plot == "Frames":
+        return build_frame_figure(in_french, mode_plot, yaxis_column_name, size_column_name, frame)
+    # The binned density map is always animated from the cell values
+    if render_plot == "Compact" or mode_plot == "Density":
+        return compact_figure_cache.get(bool(in_french), mode_plot, yaxis_column_name, size_column_name)
+    return main_figure_cache.get(bool(in_french), mode_plot, yaxis_column_name, size_column_name)
+
+
+@app.callback(
+    Output('main-graphic', 'figure', allow_duplicate=True),
+    Input('time-slider', 'value'),
+    State('render-plot', 'value'),
+    State('in_french', 'value'),
+    State('mode-plot', 'value'),
+    State('yaxis-column', 'value'),
+    State('size-column', 'value'),
+    prevent_initial_call=True)
+@timed_callback
+def update_frame(frame, render_plot, in_french, mode_plot, yaxis_column_name, size_column_name):
+    if render_plot != "Frames" or frame is None:
+        return no_update
+
+    # Positions and hover names are already in the browser, only the values of the frame change
+    served = artifacts
+    frame_slices = served.frame_slices
+    patched_figure = Patch()
+    if mode_plot == "Density":
+        patched_figure["data"][0]["z"] = served.hex_grid.frame(yaxis_column_name, frame)
+    else:
+        patched_figure["data"][0]["marker"]["color"] = frame_slices.frame(yaxis_column_name, frame)
+        patched_figure["data"][0]["marker"]["size"] = frame_slices.sizes(size_column_name, frame)
+    patched_figure["layout"]["annotations"][0]["text"] = frame_slices.labels(in_french)[frame]
+    return patched_figure
+
+
+@app.callback(
+    Output('time-controls', 'style'),
+    Input('render-plot', 'value'))
+@timed_callback
+def show_time_controls(render_plot):
+    return {'width': '60%', 'display': 'inline-block' if render_plot == "Frames" else 'none'}
+
+
+@app.callback(
+    Output('play-interval', 'disabled'),
+    Output('play-button', 'children'),
+    Input('play-button', 'n_clicks'))
+@timed_callback
+def toggle_play(n_clicks):
+    playing = bool(n_clicks and n_clicks % 2)
+    return not playing, '⏸' if playing else '▶'
+
+
+@app.callback(
+    Output('time-slider', 'value'),
+    Input('play-interval', 'n_intervals'),
+    State('time-slider', 'value'),
+    prevent_initial_call=True)
+@timed_callback
+def advance_frame(n_intervals, frame):
+    return ((frame or 0) + 1) % max(len(artifacts.frame_slices), 1)
+
+
 @app.callback(
     Output('specific-graphic', 'figure'),
     Input('in_french', 'value'),
-    Input('main-graphic', 'clickData'))
-def display_click_data(in_french, clickData):
+    Input('main-graphic', 'clickData'),
+    Input('specific-graphic', 'relayoutData'))
+@timed_callback
+def display_click_data(in_french, clickData, relayoutData):
     yaxis_column_name = "num_bikes_available"
     if clickData:
         data = clickData["points"][0]
+        station_id = int(data["customdata"][0])
 
         if in_french:
             y_label = pretty_names_FR[yaxis_column_name]
@@ -172,12 +395,19 @@ def display_click_data(in_french, clickData):
             y_label = pretty_names_EN[yaxis_column_name]
             title = "{} in {}".format(y_label, data["hovertext"])
 
-        dff = df_geo[(df_geo.lat == data["lat"]) & (df_geo.lon == data["lon"])]
+        # Only the zoomed range of the same station is resampled, a new click shows the whole history
+        start, end = None, None
+        if relayoutData and callback_context.triggered_id == 'specific-graphic':
+            start = relayoutData.get("xaxis.range[0]", relayoutData.get("xaxis.range", [None])[0])
+            end = relayoutData.get("xaxis.range[1]", relayoutData.get("xaxis.range", [None, None])[1])
+        with timed("history_series"):
+            dff, _ = artifacts.history_rollups.series(station_id, start, end)
 
         fig = px.scatter(dff, x="date_retrieved", y=yaxis_column_name,
                          title=title, labels={"date_retrieved": "", yaxis_column_name: y_label})
 
         fig.update_traces(marker=dict(color=color_theme["primary"]))
+        fig.update_layout(uirevision=station_id)
 
     else:
         if in_french:
@@ -211,18 +441,71 @@ def display_click_data(in_french, clickData):
     return fig
 
 
+@app.callback(
+    Output('nearby-stations', 'children'),
+    Input('in_french', 'value'),
+    Input('main-graphic', 'clickData'),
+    Input('nearby-metric', 'value'),
+    Input('data-version', 'data'))
+@timed_callback
+def display_nearby_stations(in_french, clickData, nearby_metric, data_version):
+    # Closest stations to the clicked one (or to the biggest station of a clicked cell) in the latest poll
+    if not clickData:
+        return "Cliquez sur une station" if in_french else "Click on a station"
+    coordinates = nearby.coordinates(int(clickData["points"][0]["customdata"][0]))
+    if coordinates is None:
+        return no_update
+    with timed("nearest_stations"):
+        stations = nearby.nearest(*coordinates, metric=nearby_metric)
+
+    header = ["Station", "Distance", "Vélos" if in_french else "Bikes",
+              "Électriques" if in_french else "Electrical", "Places" if in_french else "Docks"]
+    rows = [[station["name"], "{} m".format(station["distance_m"]), station["num_bikes_available"],
+             station["num_ebikes_available"], station["num_docks_available"]] for station in stations]
+    return html.Table([html.Tr([html.Th(x) for x in header])]
+                      + [html.Tr([html.Td(x) for x in row]) for row in rows])
+
+
+@app.callback(
+    Output('station-forecast', 'children'),
+    Input('in_french', 'value'),
+    Input('main-graphic', 'clickData'),
+    Input('data-version', 'data'))
+@timed_callback
+def display_station_forecast(in_french, clickData, data_version):
+    # Bikes and docks expected at the clicked station, with the chance that at least one is available
+    if not clickData:
+        return None
+    station_id = int(clickData["points"][0]["customdata"][0])
+    predictions = [forecasts.forecast(station_id, horizon) for horizon in HORIZONS]
+    if predictions[0] is None:
+        return no_update
+
+    header = ["Prévision" if in_french else "Forecast", "Vélos" if in_french else "Bikes",
+              "Places" if in_french else "Docks"]
+    rows = [["{} {} min".format("dans" if in_french else "in", horizon)]
+            + ["{:.1f} ({:.0%})".format(prediction[metric], prediction["chance_" + metric])
+               for metric in ["num_bikes_available", "num_docks_available"]]
+            for horizon, prediction in zip(HORIZONS, predictions)]
+    return html.Table([html.Tr([html.Th(x) for x in header])]
+                      + [html.Tr([html.Td(x) for x in row]) for row in rows])
+
+
 @app.callback(
     Output('clustering-graphic', 'figure'),
-    Input('in_french', 'value'))
-def update_clustering_graph(in_french):
+    Input('in_french', 'value'),
+    Input('data-version', 'data'))
+@timed_callback
+def update_clustering_graph(in_french, data_version):
     if in_french:
         labels = pretty_names_FR
     else:
         labels = pretty_names_EN
 
-    fig = px.scatter_mapbox(cluster_df, lat="lat", lon="lon", color="Cluster",
+    # One point per station, not one per station and weekday-hour
+    fig = px.scatter_mapbox(artifacts.cluster_stations, lat="lat", lon="lon", color="Cluster",
                             color_discrete_map=color_theme["discrete_scale"],
-                            hover_name="name", hover_data=["num_bikes_available"],
+                            hover_name="name", hover_data=["num_bikes_available"], custom_data=["station_id"],
                             zoom=10, labels=labels)
 
     fig.update_layout(clickmode='event+select')
@@ -242,8 +525,10 @@ def update_clustering_graph(in_french):
     Output('specific-clustering-graphic', 'figure'),
     Input('in_french', 'value'),
     Input('clustering-graphic', 'clickData'))
+@timed_callback
 def display_click_data_clustering(in_french, clickData):
     yaxis_column_name = "num_bikes_available"
+    served = artifacts
     if clickData:
         data = clickData["points"][0]
         name = data["hovertext"]
@@ -259,14 +544,15 @@ def display_click_data_clustering(in_french, clickData):
             title = "{} in {}".format(y_label, name)
             labels = pretty_names_EN
 
-        dff = group_by_geo_timeslice_df[(group_by_geo_timeslice_df.lat == data["lat"])
-                                        & (group_by_geo_timeslice_df.lon == data["lon"])]
+        station_id = int(data["customdata"][0])
+        with timed("station_rows"):
+            dff = served.timeslice_index.rows(station_id)
 
-        id_cluster = cluster_df[cluster_df.name == name].Cluster.unique()[0]
+        id_cluster = served.cluster_of_station[station_id]
 
         x_data = dff[local_day_hour].to_numpy()
         y_data = dff[yaxis_column_name].to_numpy()
-        center = cluster_centers[int(id_cluster)]
+        center = served.cluster_centers[int(id_cluster)]
 
         # Create figure with secondary y-axis
         fig = make_subplots(specs=[[{"secondary_y": True}]])
@@ -278,7 +564,7 @@ def display_click_data_clustering(in_french, clickData):
         )
 
         fig.add_trace(
-            go.Scatter(x=x_data, y=center, name="Cluster center", mode='lines',
+            go.Scatter(x=served.frame_slices.labels(in_french), y=center, name="Cluster center", mode='lines',
                        line=dict(color=color_theme["discrete_scale"][id_cluster])),
             secondary_y=True
         )
@@ -317,5 +603,37 @@ def display_click_data_clustering(in_french, clickData):
     return fig
 
 
+@app.callback(
+    Output('data-version', 'data'),
+    Input('refresh-interval', 'n_intervals'),
+    State('data-version', 'data'))
+@timed_callback
+def check_data_version(n_intervals, data_version):
+    # Figures depending on the data are only rebuilt when this worker serves a newer version than the page shows
+    version = os.path.basename(artifacts.directory)
+    return no_update if version == data_version else version
+
+
+def warm_main_figures():
+    # Only the default selection of the layout: the others are built on demand, as warming them all took longer than
+    # the refresh period and held a CPU in every worker
+    main_figure_cache.warm([(False, 'Scatter', 'frac_ebikes', 'num_bikes_available')])
+
+
+def swap_artifacts(new_artifacts):
+    # Rebinding the global is atomic, callbacks already running finish on the version they started with.
+    # Figures of the previous version which are still being built are not stored by the cache once invalidated.
+    global artifacts
+    artifacts = new_artifacts
+    nearby.refresh()
+    main_figure_cache.invalidate()
+    compact_figure_cache.invalidate()
+    warm_main_figures()
+
+
+warm_main_figures()
+refresher = Refresher(artifacts, swap_artifacts, REFRESH_PERIOD)
+refresher.start()
+
 if __name__ == "__main__":
     app.run_server() #debug=True, host='127.0.0.1')
@@ -1,39 +1,65 @@
-import locale
-from datetime import datetime
+import argparse
+import warnings
 
 import numpy as np
 import pandas as pd
-import requests
-from sklearn.cluster import KMeans
-
-def preprocess(csv_name):
-    df = pd.read_csv(csv_name, index_col=0)
-    df.legible_last_reported = df.legible_last_reported.apply(datetime.fromisoformat)
-    df.lastUpdated = df.lastUpdated.apply(datetime.fromisoformat)
-    df.date_retrieved = df.date_retrieved.apply(datetime.fromisoformat)
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from aggregates import AGGREGATES_PATH, N_SLOTS, AggregateState
+from cluster_model import CLUSTERING_PATH, ClusterModel, stable_order
+from labels import LABEL_COLUMNS, day_hour_labels, label_columns
+from metrics import timed
+from outages import EVENTS_PATH, Exclusions
+from schema import compact_history, memory_report
+from stations import INFORMATION_PATH, load_stations
+from storage import CHUNK_POLLS, SNAPSHOT_DIR, read_snapshots
+
+TIME_VARIABLE = "day_hour_of_week_num"
+
+# Aggregate by timeframe and stations
+METRICS = ['num_bikes_available',
+           'num_docks_available',
+           'num_mech_bikes_available',
+           'num_ebikes_available',
+           'occupancy',
+           'occupancy_mech',
+           'occupancy_ebikes',
+           'frac_mech',
+           'frac_ebikes',
+           'diff_ebikes',
+           'diff_mech_bikes'
+           ]
+
+GROUP_KEYS = ['station_id', 'name', 'lat', 'lon', 'capacity', 'rental_methods_str', 'Jour et heure', 'Time',
+              TIME_VARIABLE]
+
+
+def add_time_columns(df):
+    dates = df["date_retrieved"].dt
+    df["day_hour_of_week_num"] = 100 * dates.weekday + dates.hour
+    df["hour_num"] = dates.hour
+
+    # Categorical codes into the 168 precomputed labels, rather than one string per row
+    slots = dates.weekday.to_numpy() * 24 + dates.hour.to_numpy()
+    for column, labels in label_columns(slots).items():
+        df[column] = labels
+    return df
+
+
+@timed("preprocess")
+def preprocess(snapshot_dir=SNAPSHOT_DIR, start=None, end=None, information_path=INFORMATION_PATH, report=False,
+               events_path=EVENTS_PATH):
+    df = read_snapshots(snapshot_dir, start, end)
     df = df.sort_values(by="last_reported")
-    df = df[df.is_renting == 1]
+    # The polls of stations flagged by the outage detector are left out, as the collector does
+    excluded = Exclusions.load(events_path).mask(df.station_id.to_numpy(), df.date_retrieved.to_numpy())
+    df = df[(df.is_renting == 1).to_numpy() & ~excluded]
 
-    TIME_VARIABLE = "day_hour_of_week_num"
+    df = add_time_columns(df)
 
-    df["day_hour_of_week_num"] = df["date_retrieved"].apply(lambda x: 100 * x.weekday() + x.hour)
-    df["hour_num"] = df["date_retrieved"].apply(lambda x: x.hour)
-
-    locale.setlocale(locale.LC_TIME, "fr_FR")
-    df["Jour et heure"] = df["date_retrieved"].apply(lambda x: datetime.strftime(x, "%A %Hh"))
-
-    locale.setlocale(locale.LC_TIME, "en_US")
-    df["Time"] = df["date_retrieved"].apply(lambda x: datetime.strftime(x, "%A %I%p"))
-
-    req = requests.get("https://velib-metropole-opendata.smoove.pro/opendata/Velib_Metropole/station_information.json")
-    loc_stations_data = req.json()["data"]["stations"]
-    loc_stations_df = pd.DataFrame(loc_stations_data)
-    loc_stations_df["rental_methods_str"] = loc_stations_df.rental_methods.apply(lambda x: x[0] if type(x) == list
-    else "Aucun")
-
-    df_geo = df.merge(loc_stations_df, on="station_id")
+    # Join on the cached station table, already indexed by station_id
+    df_geo = df.join(load_stations(information_path), on="station_id", how="inner", lsuffix="_x", rsuffix="_y")
     df_geo = df_geo.sort_values(by='date_retrieved')
-    df_geo["date"] = df_geo.date_retrieved.astype(str)
 
     # Creating metrics
     df_geo["diff_ebikes"] = df_geo.groupby(by=['stationCode_x']).num_ebikes_available.diff()
@@ -45,67 +71,158 @@ def preprocess(csv_name):
     df_geo["frac_mech"] = df_geo.num_mech_bikes_available / df_geo.num_bikes_available
     df_geo["frac_ebikes"] = df_geo.num_ebikes_available / df_geo.num_bikes_available
 
-    # Aggregate by timeframe and stations
-    metrics = ['num_bikes_available',
-               'num_docks_available',
-               'num_mech_bikes_available',
-               'num_ebikes_available',
-               'occupancy',
-               'occupancy_mech',
-               'occupancy_ebikes',
-               'frac_mech',
-               'frac_ebikes',
-               'diff_ebikes',
-               'diff_mech_bikes'
-               ]
-
-    group_by_geo_df = df_geo.groupby(by=['station_id', 'name', 'lat', 'lon', 'capacity',
-                                         'rental_methods_str', 'Jour et heure', 'Time',
-                                         TIME_VARIABLE]).agg({x: np.mean for x in metrics}).reset_index()
+    group_by_geo_df = df_geo.groupby(by=GROUP_KEYS, observed=True).agg({x: "mean" for x in METRICS}).reset_index()
     group_by_geo_df = group_by_geo_df.sort_values(by=TIME_VARIABLE)
 
-    group_by_geo_df.fillna(0, inplace=True)
-    df_geo.fillna(0, inplace=True)
-    return group_by_geo_df, df_geo
-
+    group_by_geo_df.fillna({x: 0 for x in METRICS}, inplace=True)
+    df_geo.fillna({x: 0 for x in df_geo.columns if x not in LABEL_COLUMNS}, inplace=True)
 
-def clustering(df_geo):
-    group_by_geo_df = df_geo.groupby(by=['name', "lat", "lon", "day_hour_of_week_num"]).agg(
-        {'num_bikes_available': np.mean})
+    compact_df_geo = compact_history(df_geo)
+    if report:
+        memory_report(df_geo, compact_df_geo)
+    return group_by_geo_df, compact_df_geo
 
-    dataset, labelled_names = [], []
 
-    shape_max = group_by_geo_df.groupby(by=['name', "lat", "lon"]).size().values.max()
-
-    group_by_geo_df = group_by_geo_df.reset_index("day_hour_of_week_num")
-
-    for id_ in group_by_geo_df.index.unique():
-        name = id_[0]
-        x = group_by_geo_df.loc[name].num_bikes_available.to_numpy().copy()
-
-        # Normalize
-        if x.shape[0] == shape_max:
-            if x.max():
-                x /= x.max()
-            else:
-                continue
-            labelled_names.append(name)
-            dataset.append(x)
-        else:
-            pass
+def aggregates_to_frame(state, information_path=INFORMATION_PATH):
+    # Same rows, order and types as the group_by_geo_df of preprocess
+    stations_df = load_stations(information_path)[['name', 'lat', 'lon', 'capacity', 'rental_methods_str']]
+    group_by_geo_df = state.to_frame(stations_df).merge(day_hour_labels(), on=TIME_VARIABLE)
+    group_by_geo_df = group_by_geo_df[GROUP_KEYS + METRICS].sort_values(by=['station_id', TIME_VARIABLE])
+    group_by_geo_df = group_by_geo_df.astype({'rental_methods_str': "str", TIME_VARIABLE: "int32",
+                                              "diff_ebikes": "float32", "diff_mech_bikes": "float32"})
+    group_by_geo_df = group_by_geo_df.reset_index(drop=True)
+    group_by_geo_df = group_by_geo_df.sort_values(by=TIME_VARIABLE)
 
-    dataset = np.array(dataset)
-    group_by_geo_df = group_by_geo_df.reset_index()
+    group_by_geo_df.fillna({x: 0 for x in METRICS}, inplace=True)
+    return group_by_geo_df
+
+
+@timed("preprocess_incremental")
+def preprocess_incremental(snapshot_dir=SNAPSHOT_DIR, state_path=AGGREGATES_PATH, information_path=INFORMATION_PATH,
+                           events_path=EVENTS_PATH):
+    # Only the polls written since the last run are folded into the persisted aggregates
+    state = AggregateState.load(state_path)
+    if state.update_from_store(snapshot_dir, exclusions=Exclusions.load(events_path)):
+        state.save(state_path)
+    return aggregates_to_frame(state, information_path)
+
+
+@timed("preprocess_streaming")
+def preprocess_streaming(snapshot_dir=SNAPSHOT_DIR, start=None, end=None, information_path=INFORMATION_PATH,
+                         chunk_polls=CHUNK_POLLS, events_path=EVENTS_PATH):
+    # Out-of-core version of the group_by_geo_df of preprocess: the history is read chunk_polls polls at a time and
+    # folded into per-(station, weekday-hour) sums and counts, so that the memory does not grow with its length
+    state = AggregateState()
+    state.update_from_store(snapshot_dir, start, end, chunk_polls, Exclusions.load(events_path))
+    return aggregates_to_frame(state, information_path)
+
+
+def station_profiles(df_geo, column='num_bikes_available'):
+    # Dense stations x weekday-hour matrix of the mean of column, NaN where a station was never seen
+    profiles = df_geo.groupby(by=['station_id', TIME_VARIABLE])[column].mean()
+    station_ids, rows = np.unique(profiles.index.get_level_values('station_id'), return_inverse=True)
+    day_hours = profiles.index.get_level_values(TIME_VARIABLE).to_numpy()
+
+    matrix = np.full((len(station_ids), N_SLOTS), np.nan)
+    matrix[rows.ravel(), 24 * (day_hours // 100) + day_hours % 100] = profiles.to_numpy()
+    return station_ids, matrix
+
+
+def impute_profiles(matrix):
+    # Missing slots take the mean of the station at the same hour on the other days, then its overall mean
+    by_hour = matrix.reshape(len(matrix), 7, 24)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        hour_means = np.nanmean(by_hour, axis=1)
+        station_means = np.nanmean(matrix, axis=1)
+    imputed = np.where(np.isnan(by_hour), hour_means[:, None, :], by_hour).reshape(matrix.shape)
+    return np.where(np.isnan(imputed), station_means[:, None], imputed)
+
+
+def clustering_model(algorithm, n_clusters, n_jobs=None, init=None):
+    # init are the centers of a previous fit to warm-start from
+    if algorithm == "kmeans":
+        return KMeans(n_clusters=n_clusters) if init is None else KMeans(n_clusters=n_clusters, init=init, n_init=1)
+    if algorithm == "minibatch":
+        if init is None:
+            return MiniBatchKMeans(n_clusters=n_clusters, batch_size=1024)
+        return MiniBatchKMeans(n_clusters=n_clusters, batch_size=1024, init=init, n_init=1)
+    if algorithm in ("softdtw", "dtw"):
+        try:
+            from tslearn.clustering import TimeSeriesKMeans
+        except ImportError:
+            raise ImportError("The {} clustering needs tslearn, install it with pip install tslearn".format(algorithm))
+        return TimeSeriesKMeans(n_clusters=n_clusters, metric=algorithm, max_iter=10, n_jobs=n_jobs,
+                                init="k-means++" if init is None else init[:, :, None])
+    raise ValueError("Unknown clustering algorithm {}".format(algorithm))
+
+
+def normalized_profiles(df_geo):
+    station_ids, matrix = station_profiles(df_geo)
+
+    # Slots never observed for any station, e.g. with less than a week of history, are left out of the fit
+    observed = ~np.isnan(matrix).all(axis=0)
+    dataset = impute_profiles(matrix)
+
+    # Normalize
+    maxima = np.nanmax(np.where(observed, dataset, np.nan), axis=1)
+    labelled = maxima > 0
+    return station_ids[labelled], dataset[labelled] / maxima[labelled, None], observed
+
+
+def fit_clustering(dataset, observed, algorithm="kmeans", n_clusters=3, n_jobs=None, previous=None, station_ids=None):
+    # Warm-start from the previous centers when they cover the same slots, keeping their numbering
+    warm_start = previous is not None and previous.n_clusters == n_clusters and np.array_equal(previous.observed,
+                                                                                             observed)
+    model = clustering_model(algorithm, n_clusters, n_jobs, previous.centers if warm_start else None)
 
     print("before model")
 
-    # model = TimeSeriesKMeans(n_clusters=3, metric="softdtw", max_iter=10)
-    model = KMeans(n_clusters=3)
-    model.fit(dataset)
+    labels = model.fit_predict(dataset[:, observed])
+    centers = model.cluster_centers_.reshape(n_clusters, -1)
 
     print("after model")
 
-    cluster_df = group_by_geo_df[group_by_geo_df.name.isin(labelled_names)]
-    cluster_df.loc[:, "Cluster"] = cluster_df.name.apply(lambda x: str(model.labels_[labelled_names.index(x)]))
-
-    return cluster_df, model.cluster_centers_
+    if not warm_start:
+        order, rank = stable_order(centers)
+        centers, labels = centers[order], rank[labels]
+    return ClusterModel(centers, observed, algorithm, station_ids=station_ids, labels=labels), labels
+
+
+@timed("clustering")
+def clustering(df_geo, algorithm="kmeans", n_clusters=3, n_jobs=None, model_path=CLUSTERING_PATH, refit=False,
+               max_age=None, events_path=EVENTS_PATH):
+    station_ids, dataset, observed = normalized_profiles(df_geo)
+    # Stations currently flagged by the outage detector are left unlabelled
+    kept = ~np.isin(station_ids, Exclusions.load(events_path).open_stations)
+    station_ids, dataset = station_ids[kept], dataset[kept]
+
+    # The persisted model is reused, the stations of its fit keeping their label and new ones being assigned to its
+    # centers, unless a refit is asked for, the model is older than max_age seconds or it was fitted on other
+    # weekday-hour slots, e.g. before a full week of history, its centers then not lining up with the slots shown
+    model = ClusterModel.load(model_path)
+    if (model is None or refit or (max_age is not None and model.age > max_age)
+            or model.algorithm != algorithm or model.n_clusters != n_clusters
+            or not np.array_equal(model.observed, observed)):
+        model, labels = fit_clustering(dataset, observed, algorithm, n_clusters, n_jobs, model, station_ids)
+        model.save(model_path)
+    else:
+        labels = model.assign_stations(station_ids, dataset)
+
+    group_by_geo_df = df_geo.groupby(by=['station_id', 'name', "lat", "lon", TIME_VARIABLE], observed=True).agg(
+        {"num_bikes_available": "mean"}).reset_index()
+    cluster_df = group_by_geo_df.merge(pd.DataFrame({'station_id': station_ids, 'Cluster': labels.astype(str)}),
+                                       on='station_id')
+
+    return cluster_df, model.centers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refit the station clustering on the whole history")
+    parser.add_argument("--algorithm", default="kmeans", choices=["kmeans", "minibatch", "softdtw", "dtw"])
+    parser.add_argument("--n-clusters", type=int, default=3)
+    parser.add_argument("--n-jobs", type=int, default=None)
+    args = parser.parse_args()
+
+    _, df_geo = preprocess()
+    clustering(df_geo, args.algorithm, args.n_clusters, args.n_jobs, refit=True)
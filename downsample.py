@@ -0,0 +1,224 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from station_index import StationIndex
+
+MAX_POINTS = 1000
+
+# Resolutions from the finest to the coarsest: the polls themselves, then pandas frequencies
+RESOLUTIONS = ["raw", "h", "D"]
+
+
+def lttb(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: indices of n_out points that keep the visual shape of the series
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.zeros(n_out, dtype=int)
+    selected[-1] = n - 1
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_start, next_stop = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        avg_x, avg_y = x[next_start:next_stop].mean(), y[next_start:next_stop].mean()
+
+        a = selected[i]
+        area = np.abs((x[a] - avg_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (avg_y - y[a]))
+        selected[i + 1] = start + np.argmax(area)
+    return selected
+
+
+def roll_up(station_ids, dates, values, column, date_column="date_retrieved", resolutions=RESOLUTIONS):
+    # Levels of the given polls, every one a set of flat arrays sorted by station and date
+    raw = pd.DataFrame({"station_id": station_ids, date_column: dates.astype("datetime64[s]"),
+                        column: values.astype("float32")})
+    levels = {}
+    for resolution in resolutions:
+        if resolution == "raw":
+            rollup = raw
+        else:
+            rollup = raw.groupby(["station_id", raw[date_column].dt.floor(resolution)])[column].mean().reset_index()
+        index = StationIndex(rollup, date_column)
+        bounds = np.array(list(index.bounds.values()), dtype="int64").reshape(-1, 2)
+        levels[resolution] = {"station_ids": np.array(list(index.bounds), dtype="int64"),
+                              "starts": bounds[:, 0],
+                              "stops": bounds[:, 1],
+                              "dates": index.df[date_column].to_numpy().astype("datetime64[s]"),
+                              "values": index.df[column].to_numpy(dtype="float32")}
+    return levels
+
+
+def row_station_ids(level):
+    return np.repeat(level["station_ids"], np.asarray(level["stops"]) - np.asarray(level["starts"]))
+
+
+def concat_levels(first, second):
+    # Per-station concatenation of two levels, the rows of second coming after those of first. Every row is copied
+    # once to the start of its station in the result plus its offset in its own level.
+    station_ids = np.union1d(first["station_ids"], second["station_ids"])
+    sizes = []
+    for level in (first, second):
+        size = np.zeros(len(station_ids), dtype="int64")
+        size[np.searchsorted(station_ids, level["station_ids"])] = np.asarray(level["stops"]) - np.asarray(
+            level["starts"])
+        sizes.append(size)
+    stops = np.cumsum(sizes[0] + sizes[1])
+    starts = stops - sizes[0] - sizes[1]
+
+    merged = {"station_ids": station_ids, "starts": starts, "stops": stops}
+    for name in ["dates", "values"]:
+        merged[name] = np.empty(stops[-1] if len(stops) else 0, dtype=first[name].dtype)
+    for level, offsets in [(first, starts), (second, starts + sizes[0])]:
+        level_starts = np.asarray(level["starts"])
+        rows = offsets[np.searchsorted(station_ids, level["station_ids"])]
+        destinations = np.repeat(rows - level_starts, np.asarray(level["stops"]) - level_starts) + np.arange(
+            len(level["dates"]))
+        for name in ["dates", "values"]:
+            merged[name][destinations] = level[name]
+    return merged
+
+
+def cutoff(dates, resolutions=RESOLUTIONS):
+    # Start of the last bucket of the coarsest rollup, the buckets of every level before it being complete
+    coarsest = [resolution for resolution in resolutions if resolution != "raw"]
+    last = pd.Timestamp(dates.max())
+    return np.datetime64(last.floor(coarsest[-1]) if coarsest else last + pd.Timedelta(seconds=1), "s")
+
+
+def save_levels(levels, directory, source=None):
+    # The files of source, holding the same levels, are hard linked rather than written again
+    for resolution, level in levels.items():
+        os.makedirs(os.path.join(directory, resolution), exist_ok=True)
+        for name, array in level.items():
+            path = os.path.join(directory, resolution, name + ".npy")
+            if source is not None:
+                try:
+                    os.link(os.path.join(source, resolution, name + ".npy"), path)
+                    continue
+                except OSError:
+                    pass
+            np.save(path, array)
+
+
+def load_levels(directory, mmap_mode="r"):
+    levels = {}
+    for resolution in sorted(os.listdir(directory), key=RESOLUTIONS.index):
+        levels[resolution] = {name: np.load(os.path.join(directory, resolution, name + ".npy"), mmap_mode=mmap_mode)
+                              for name in ["station_ids", "starts", "stops", "dates", "values"]}
+    return levels
+
+
+class Rollups:
+    # Per-station means of a column at each resolution, so that a long visible range is read from a coarse rollup
+    # and only then thinned down with LTTB. Every level is a set of flat arrays sorted by station and date, which
+    # can be saved and memory-mapped back.
+    # The levels are split in a base, whose buckets are complete at every resolution, and a tail of the polls since
+    # the last bucket of the coarsest rollup started. New polls only roll the tail up again: the base is merged with
+    # the tail once a day and is otherwise shared by the saved versions through hard links.
+
+    def __init__(self, levels, column, date_column="date_retrieved", tail=None, base_directory=None):
+        self.levels = levels
+        self.tail = tail if tail is not None else roll_up(np.zeros(0, dtype="int64"),
+                                                          np.zeros(0, dtype="datetime64[s]"), np.zeros(0), column,
+                                                          date_column, list(levels))
+        self.column = column
+        self.date_column = date_column
+        # Directory the base was loaded from, which save() links to
+        self.base_directory = base_directory
+        self._parts = [(part, {resolution: {id_: (start, stop) for id_, start, stop in
+                                            zip(level["station_ids"].tolist(), level["starts"], level["stops"])}
+                               for resolution, level in part.items()})
+                       for part in (self.levels, self.tail)]
+
+    @classmethod
+    def from_frame(cls, df, column, date_column="date_retrieved", resolutions=RESOLUTIONS):
+        return cls.from_arrays(df.station_id.to_numpy(), df[date_column].to_numpy(), df[column].to_numpy(), column,
+                               date_column, resolutions)
+
+    @classmethod
+    def from_arrays(cls, station_ids, dates, values, column, date_column="date_retrieved", resolutions=RESOLUTIONS):
+        dates = dates.astype("datetime64[s]")
+        complete = dates < cutoff(dates, resolutions) if len(dates) else np.zeros(0, dtype=bool)
+        return cls(roll_up(station_ids[complete], dates[complete], values[complete], column, date_column,
+                           resolutions),
+                   column, date_column,
+                   roll_up(station_ids[~complete], dates[~complete], values[~complete], column, date_column,
+                           resolutions))
+
+    @property
+    def first_date(self):
+        for part in (self.levels, self.tail):
+            raw = part["raw"]
+            if len(raw["dates"]):
+                return pd.Timestamp(raw["dates"][np.asarray(raw["starts"])].min())
+        return None
+
+    @property
+    def last_date(self):
+        for part in (self.tail, self.levels):
+            raw = part["raw"]
+            if len(raw["dates"]):
+                return pd.Timestamp(raw["dates"][np.asarray(raw["stops"]) - 1].max())
+        return None
+
+    def extend(self, station_ids, dates, values):
+        # New polls, later than last_date, are added to the raw polls of the tail, which is rolled up again. The ones
+        # before the last bucket of the coarsest rollup then have all their buckets complete and move to the base.
+        raw = self.tail["raw"]
+        station_ids = np.concatenate([row_station_ids(raw), station_ids])
+        dates = np.concatenate([raw["dates"], dates.astype("datetime64[s]")])
+        values = np.concatenate([raw["values"], values.astype("float32")])
+        resolutions = list(self.levels)
+
+        complete = dates < cutoff(dates, resolutions) if len(dates) else np.zeros(0, dtype=bool)
+        tail = roll_up(station_ids[~complete], dates[~complete], values[~complete], self.column, self.date_column,
+                       resolutions)
+        if not complete.any():
+            return Rollups(self.levels, self.column, self.date_column, tail, self.base_directory)
+        completed = roll_up(station_ids[complete], dates[complete], values[complete], self.column, self.date_column,
+                            resolutions)
+        levels = {resolution: concat_levels(self.levels[resolution], completed[resolution])
+                  for resolution in resolutions}
+        return Rollups(levels, self.column, self.date_column, tail)
+
+    def save(self, directory):
+        save_levels(self.levels, os.path.join(directory, "base"), self.base_directory)
+        save_levels(self.tail, os.path.join(directory, "tail"))
+
+    @classmethod
+    def load(cls, directory, column, date_column="date_retrieved", mmap_mode="r"):
+        base_directory = os.path.join(directory, "base")
+        if not os.path.isdir(base_directory):
+            # Versions saved before the tail, split once
+            raw = load_levels(directory, mmap_mode)["raw"]
+            return cls.from_arrays(row_station_ids(raw), raw["dates"], raw["values"], column, date_column,
+                                   sorted(os.listdir(directory), key=RESOLUTIONS.index))
+        return cls(load_levels(base_directory, mmap_mode), column, date_column,
+                   load_levels(os.path.join(directory, "tail"), mmap_mode), base_directory)
+
+    def series(self, station_id, start=None, end=None, max_points=MAX_POINTS):
+        for resolution in self.levels:
+            slices = [self._slice(part[resolution], bounds[resolution], station_id, start, end)
+                      for part, bounds in self._parts]
+            # LTTB keeps the shape well up to a reduction of about 10x, beyond that a coarser rollup is used
+            if sum(len(dates) for dates, _ in slices) <= 10 * max_points:
+                break
+
+        dates = np.concatenate([dates for dates, _ in slices])
+        values = np.concatenate([values for _, values in slices]).astype("float64")
+        selected = lttb(dates.astype("float64"), values, max_points)
+        return pd.DataFrame({self.date_column: dates[selected], self.column: values[selected]}), resolution
+
+    @staticmethod
+    def _slice(level, bounds, station_id, start=None, end=None):
+        first, last = bounds.get(station_id, (0, 0))
+        dates = level["dates"][first:last]
+        if start is not None:
+            first += np.searchsorted(dates, np.datetime64(pd.Timestamp(start), "s"), "left")
+        if end is not None:
+            last = first + np.searchsorted(level["dates"][first:last], np.datetime64(pd.Timestamp(end), "s"),
+                                           "right")
+        return level["dates"][first:last], level["values"][first:last]
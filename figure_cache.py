@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from plotly.basedatatypes import BasePlotlyType
+
+
+def value_size(value):
+    # Bytes of the arrays and characters of the strings
+    if isinstance(value, dict):
+        return sum(value_size(x) for x in value.values())
+    if isinstance(value, np.ndarray):
+        return value.nbytes if value.dtype != object else sum(len(str(x)) for x in value.ravel())
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(x) for x in value)
+    return 0 if value is None else len(str(value))
+
+
+def figure_size(figure):
+    # About what the traces and frames of the figure, a go.Figure or its dict, hold in memory, the layout being small
+    # next to them. The traces are read one at a time rather than serializing the whole figure.
+    frames = figure["frames"] if "frames" in figure else None
+    traces = list(figure["data"]) + [trace for frame in frames or () for trace in frame["data"]]
+    return sum(value_size(trace.to_plotly_json() if isinstance(trace, BasePlotlyType) else trace) for trace in traces)
+
+
+class FigureCache:
+    # LRU of built figures bounded by the bytes of their traces, the most recent one being kept even when it is bigger
+    # on its own. invalidate() drops them all, e.g. when the underlying data is refreshed, and a figure whose build
+    # started before the invalidation is returned but never stored.
+
+    def __init__(self, build, max_bytes=64 * 2 ** 20, size=figure_size):
+        self.build = build
+        self.max_bytes = max_bytes
+        self.size = size
+        self.generation = 0
+        self.n_bytes = 0
+        self._figures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, *key):
+        with self._lock:
+            if key in self._figures:
+                self._figures.move_to_end(key)
+                return self._figures[key][0]
+            generation = self.generation
+
+        figure = self.build(*key)
+        n_bytes = self.size(figure)
+
+        with self._lock:
+            if generation == self.generation:
+                if key in self._figures:
+                    self.n_bytes -= self._figures.pop(key)[1]
+                self._figures[key] = (figure, n_bytes)
+                self.n_bytes += n_bytes
+                while self.n_bytes > self.max_bytes and len(self._figures) > 1:
+                    self.n_bytes -= self._figures.popitem(last=False)[1][1]
+        return figure
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._figures.clear()
+            self.n_bytes = 0
+
+    def __contains__(self, key):
+        return key in self._figures
+
+    def __len__(self):
+        return len(self._figures)
+
+    def warm(self, keys):
+        keys = list(keys)
+        generation = self.generation
+
+        def run():
+            for key in keys:
+                if generation != self.generation:
+                    return
+                self.get(*key)
+
+        thread = threading.Thread(target=run, name="figure-cache-warmup", daemon=True)
+        thread.start()
+        return thread
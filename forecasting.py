@@ -0,0 +1,280 @@
+import argparse
+import math
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from aggregates import N_SLOTS, slot_of
+from metrics import timed
+from storage import POLL_FORMAT, SNAPSHOT_DIR, list_snapshots, read_snapshots
+
+FORECASTS_PATH = "forecasts.npz"
+
+FORECAST_METRICS = ['num_bikes_available', 'num_docks_available']
+# Minutes ahead of the last poll, on the grid of the polling period
+STEP = pd.Timedelta(minutes=15)
+HORIZONS = (15, 30, 60, 120)
+# Days of history the models are fitted on
+FIT_DAYS = 28
+
+
+def poll_matrix(df, metrics=FORECAST_METRICS, step=STEP):
+    # Dense (time, station, metric) values on a regular grid of step, NaN where a station did not report. The dates
+    # can be datetimes or epoch seconds as in the compact history.
+    station_ids, station_idx = np.unique(df.station_id.to_numpy(), return_inverse=True)
+    dates = df.date_retrieved.to_numpy().astype("datetime64[s]")
+    step_seconds = int(step.total_seconds())
+    start = dates.min() if len(dates) else np.datetime64(0, "s")
+    time_idx = np.round((dates - start).astype("int64") / step_seconds).astype("int64")
+
+    n_times = int(time_idx.max()) + 1 if len(dates) else 0
+    values = np.full((n_times, len(station_ids), len(metrics)), np.nan, dtype="float32")
+    values[time_idx, station_idx.ravel()] = df[metrics].to_numpy(dtype="float32")
+    times = start + np.arange(n_times) * np.timedelta64(step_seconds, "s")
+    return station_ids, times, values
+
+
+def seasonal_profiles(slots, values):
+    # Mean of every (station, weekday-hour, metric), the weekday-hours never observed falling back to the mean of the
+    # station and then to 0
+    valid = ~np.isnan(values)
+    sums = np.zeros((N_SLOTS,) + values.shape[1:])
+    counts = np.zeros((N_SLOTS,) + values.shape[1:])
+    np.add.at(sums, slots, np.where(valid, values, 0))
+    np.add.at(counts, slots, valid)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        profiles = sums / counts
+        station_means = sums.sum(axis=0) / counts.sum(axis=0)
+    profiles = np.where(np.isnan(profiles), station_means, profiles)
+    return np.nan_to_num(profiles).transpose(1, 0, 2).astype("float32")
+
+
+def residual_terms(residuals, steps):
+    # Least squares coefficient of the residual steps later on the current one, per station and metric, clipped to
+    # [0, 1], and the standard deviation of the errors left
+    phi = np.zeros((len(steps),) + residuals.shape[1:], dtype="float32")
+    sigma = np.ones((len(steps),) + residuals.shape[1:], dtype="float32")
+    for h, k in enumerate(steps):
+        if len(residuals) <= k:
+            continue
+        now, later = residuals[:-k], residuals[k:]
+        valid = ~np.isnan(now) & ~np.isnan(later)
+        now, later = np.where(valid, now, 0), np.where(valid, later, 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            phi[h] = np.nan_to_num(np.clip((now * later).sum(axis=0) / (now * now).sum(axis=0), 0, 1))
+            errors = np.sqrt(((later - phi[h] * now) ** 2).sum(axis=0) / valid.sum(axis=0))
+        sigma[h] = np.where(np.isnan(errors) | (errors == 0), 1, errors)
+    return phi, sigma
+
+
+class Forecaster:
+    # Seasonal weekday-hour profile of every station plus a direct autoregressive term per horizon on the current
+    # deviation from it, fitted for all stations at once. refresh() computes the forecasts of all the horizons from
+    # the latest poll, which are then looked up by station.
+
+    def __init__(self, station_ids, profiles, phi, sigma, horizons=HORIZONS, metrics=FORECAST_METRICS,
+                 forecasts=None, issued_at=None):
+        self.station_ids = station_ids
+        self.profiles = profiles
+        self.phi = phi
+        self.sigma = sigma
+        self.horizons = tuple(int(h) for h in horizons)
+        self.metrics = list(metrics)
+        self.forecasts = forecasts
+        self.issued_at = issued_at
+        self._rows = {id_: row for row, id_ in enumerate(self.station_ids.tolist())}
+        self._horizons = {h: i for i, h in enumerate(self.horizons)}
+        self._metrics = {metric: i for i, metric in enumerate(self.metrics)}
+
+    @classmethod
+    def from_arrays(cls, station_ids, times, values, horizons=HORIZONS, metrics=FORECAST_METRICS, step=STEP):
+        slots = slot_of(times)
+        profiles = seasonal_profiles(slots, values)
+        residuals = values - profiles[:, slots].transpose(1, 0, 2)
+        steps = [max(int(round(pd.Timedelta(minutes=h) / step)), 1) for h in horizons]
+        phi, sigma = residual_terms(residuals, steps)
+        return cls(station_ids, profiles, phi.transpose(1, 0, 2), sigma.transpose(1, 0, 2), horizons, metrics)
+
+    @classmethod
+    def from_frame(cls, df, horizons=HORIZONS, metrics=FORECAST_METRICS, step=STEP):
+        station_ids, times, values = poll_matrix(df, metrics, step)
+        forecaster = cls.from_arrays(station_ids, times, values, horizons, metrics, step)
+        if len(times):
+            forecaster.refresh_arrays(station_ids, values[-1], times[-1])
+        return forecaster
+
+    def predict(self, rows, current, date):
+        # (station, horizon, metric) forecasts of the given rows from their current values at date
+        slots = slot_of([pd.Timestamp(date) + pd.Timedelta(minutes=h) for h in (0,) + self.horizons])
+        profiles = self.profiles[rows][:, slots]
+        residuals = np.nan_to_num(current - profiles[:, 0])
+        return np.clip(profiles[:, 1:] + self.phi[rows] * residuals[:, None], 0, None)
+
+    def refresh_arrays(self, station_ids, current, date):
+        # Stations missing from the poll only get their seasonal profile
+        rows = np.array([self._rows.get(id_, -1) for id_ in station_ids.tolist()], dtype="int64")
+        known = rows >= 0
+        values = np.full((len(self.station_ids), len(self.metrics)), np.nan, dtype="float32")
+        values[rows[known]] = current[known]
+        self.forecasts = self.predict(np.arange(len(self.station_ids)), values, date).astype("float32")
+        self.issued_at = pd.Timestamp(date)
+
+    def refresh(self, poll):
+        poll = poll[poll.is_renting == 1] if "is_renting" in poll.columns else poll
+        self.refresh_arrays(poll.station_id.to_numpy(), poll[self.metrics].to_numpy(dtype="float32"),
+                            poll.date_retrieved.max())
+
+    def forecast(self, station_id, horizon=30):
+        # Forecast of every metric at issued_at + horizon minutes, and the chance that at least one is available
+        # under a normal error. None for unknown stations or before the first refresh.
+        row = self._rows.get(station_id)
+        if row is None or self.forecasts is None:
+            return None
+        h = self._horizons[horizon]
+        result = {"date": self.issued_at + pd.Timedelta(minutes=horizon)}
+        for metric, m in self._metrics.items():
+            mean, sigma = float(self.forecasts[row, h, m]), float(self.sigma[row, h, m])
+            result[metric] = mean
+            result["chance_" + metric] = 0.5 * (1 + math.erf((mean - 0.5) / (sigma * math.sqrt(2))))
+        return result
+
+    def save(self, path=FORECASTS_PATH):
+        tmp_path = path + ".tmp"
+        issued_at = np.datetime64(self.issued_at, "s") if self.issued_at is not None else np.datetime64("NaT", "s")
+        forecasts = self.forecasts if self.forecasts is not None else np.zeros((0,) + self.phi.shape[1:])
+        with open(tmp_path, "wb") as f:
+            np.savez(f, station_ids=self.station_ids, profiles=self.profiles, phi=self.phi, sigma=self.sigma,
+                     horizons=np.array(self.horizons), metrics=np.array(self.metrics), forecasts=forecasts,
+                     issued_at=issued_at)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=FORECASTS_PATH):
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            issued_at = data["issued_at"][()]
+            issued_at = pd.Timestamp(issued_at) if not np.isnat(issued_at) else None
+            forecasts = data["forecasts"] if len(data["forecasts"]) else None
+            return cls(data["station_ids"], data["profiles"], data["phi"], data["sigma"], data["horizons"],
+                       data["metrics"].tolist(), forecasts, issued_at)
+
+
+class ForecastReader:
+    # Forecasts of the poller's latest refresh for the Dash workers, loaded again only once the file changed
+
+    def __init__(self, path=FORECASTS_PATH):
+        self.path = path
+        self._loaded = (None, None)
+
+    def current(self):
+        modified_at = os.stat(self.path).st_mtime_ns if os.path.exists(self.path) else None
+        loaded_at, forecaster = self._loaded
+        if modified_at != loaded_at:
+            forecaster = Forecaster.load(self.path)
+            self._loaded = (modified_at, forecaster)
+        return forecaster
+
+    def forecast(self, station_id, horizon=30):
+        forecaster = self.current()
+        return None if forecaster is None else forecaster.forecast(station_id, horizon)
+
+
+def register(server, forecasts):
+    # GET /api/forecast?station_id=213688169&horizon=30
+    from flask import jsonify, request
+
+    @server.route("/api/forecast")
+    def forecast():
+        try:
+            station_id = int(request.args["station_id"])
+            horizon = int(request.args.get("horizon", 30))
+            if horizon not in HORIZONS:
+                raise ValueError(horizon)
+        except (KeyError, ValueError):
+            return jsonify({"error": "expects station_id and optionally horizon among {} minutes".format(
+                ", ".join(str(h) for h in HORIZONS))}), 400
+        result = forecasts.forecast(station_id, horizon)
+        if result is None:
+            return jsonify({"error": "no forecast for station {}".format(station_id)}), 404
+        return jsonify(dict(result, station_id=station_id, horizon=horizon, date=str(result["date"])))
+
+
+@timed("fit_forecasts")
+def fit_forecasts(df, days=FIT_DAYS, path=FORECASTS_PATH):
+    # df holds the polls of the renting stations, with datetimes or epoch seconds
+    dates = df.date_retrieved.to_numpy().astype("datetime64[s]")
+    if len(dates):
+        df = df[dates >= dates.max() - np.timedelta64(days, "D")]
+    forecaster = Forecaster.from_frame(df)
+    forecaster.save(path)
+    return forecaster
+
+
+def refresh_forecasts(poll, path=FORECASTS_PATH):
+    # Called after each poll, until the models are fitted again
+    forecaster = Forecaster.load(path)
+    if forecaster is None:
+        return None
+    forecaster.refresh(poll)
+    forecaster.save(path)
+    return forecaster
+
+
+def read_history(root=SNAPSHOT_DIR, days=FIT_DAYS):
+    # Polls of the renting stations over the last days of the store
+    paths = list_snapshots(root)
+    start = None
+    if paths:
+        start = datetime.strptime(os.path.basename(paths[-1])[:-len(".npz")], POLL_FORMAT) - timedelta(days=days)
+    df = read_snapshots(root, start=start, columns=["station_id", "date_retrieved", "is_renting"] + FORECAST_METRICS)
+    return df[df.is_renting == 1]
+
+
+def backtest(df, test_days=7, horizons=HORIZONS, metrics=FORECAST_METRICS, step=STEP):
+    # Fits on the history before the last test_days, then forecasts from every time of the test days and compares
+    # with what was observed, along with the persistence of the current value and the seasonal profile alone.
+    # Returns the mean absolute errors per horizon, model and metric.
+    station_ids, times, values = poll_matrix(df, metrics, step)
+    split = int(np.searchsorted(times, times[-1] - np.timedelta64(test_days, "D")))
+    if split == 0:
+        raise ValueError("The history is shorter than the {} test days".format(test_days))
+    forecaster = Forecaster.from_arrays(station_ids, times[:split], values[:split], horizons, metrics, step)
+
+    rows = []
+    slots = slot_of(times)
+    test = values[split:]
+    seasonal = forecaster.profiles[:, slots[split:]].transpose(1, 0, 2)
+    for h, horizon in enumerate(horizons):
+        k = max(int(round(pd.Timedelta(minutes=horizon) / step)), 1)
+        if len(test) <= k:
+            continue
+        now, later = test[:-k], test[k:]
+        residuals = np.nan_to_num(now - seasonal[:-k])
+        predictions = {"persistence": now,
+                       "seasonal": seasonal[k:],
+                       "seasonal+ar": np.clip(seasonal[k:] + forecaster.phi[:, h] * residuals, 0, None)}
+        for model, predicted in predictions.items():
+            errors = np.abs(predicted - later)
+            errors[np.isnan(now) | np.isnan(later)] = np.nan
+            rows.append(dict({"horizon": horizon, "model": model},
+                             **{metric: float(np.nanmean(errors[..., m])) for m, metric in enumerate(metrics)}))
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the availability forecasts on the stored history")
+    parser.add_argument("--snapshot-dir", default=SNAPSHOT_DIR)
+    parser.add_argument("--days", type=int, default=FIT_DAYS, help="Days of history to fit on")
+    parser.add_argument("--backtest", type=int, default=None, metavar="TEST_DAYS",
+                        help="Only report the errors on the last TEST_DAYS, fitting on the days before them")
+    args = parser.parse_args()
+
+    if args.backtest:
+        history = read_history(args.snapshot_dir, args.days + args.backtest)
+        print(backtest(history, args.backtest).to_string(index=False))
+    else:
+        fit_forecasts(read_history(args.snapshot_dir, args.days))
+        print("Forecasts written to {}".format(FORECASTS_PATH))
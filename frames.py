@@ -0,0 +1,67 @@
+import base64
+
+import dash
+import numpy as np
+from plotly.offline import get_plotlyjs_version
+
+from aggregates import TIME_VARIABLE
+from labels import LABELS_EN, LABELS_FR
+
+
+def _version(version):
+    return tuple(int(part) for part in version.split(".")[:2])
+
+
+# plotly.js decodes the binary arrays {"dtype", "bdata"} since 2.28. Dash serves the plotly.js of the plotly package
+# since 3.0, older versions bundle their own, older, plotly.js.
+TYPED_ARRAYS = _version(dash.__version__) >= (3, 0) and _version(get_plotlyjs_version()) >= (2, 28)
+
+
+def encode(values, decimals=2):
+    # Compact form of the arrays sent to the browser: base64 float32 when supported, else rounded numbers
+    values = np.asarray(values, dtype="<f4")
+    if TYPED_ARRAYS:
+        return {"dtype": "f4", "bdata": base64.b64encode(values.tobytes()).decode("ascii")}
+    return np.round(values, decimals)
+
+
+class FrameSlices:
+    # Dense (frame, station) arrays of every metric, so that the map can be redrawn one weekday-hour at a time
+    # without filtering group_by_geo_timeslice_df. Stations missing from a frame are NaN.
+
+    def __init__(self, group_by_geo_df, metrics):
+        stations_df = group_by_geo_df.drop_duplicates("station_id").sort_values("station_id")
+        self.station_ids = stations_df.station_id.to_numpy()
+        self.names = stations_df.name.to_numpy()
+        self.lat = stations_df.lat.to_numpy()
+        self.lon = stations_df.lon.to_numpy()
+        self.capacity = stations_df.capacity.to_numpy()
+
+        self.day_hours = np.sort(group_by_geo_df[TIME_VARIABLE].unique())
+        slots = 24 * (self.day_hours // 100) + self.day_hours % 100
+        self.labels_fr = [LABELS_FR[slot] for slot in slots]
+        self.labels_en = [LABELS_EN[slot] for slot in slots]
+
+        frame_idx = np.searchsorted(self.day_hours, group_by_geo_df[TIME_VARIABLE].to_numpy())
+        station_idx = np.searchsorted(self.station_ids, group_by_geo_df.station_id.to_numpy())
+        self.values = {}
+        for metric in metrics:
+            values = np.full((len(self.day_hours), len(self.station_ids)), np.nan, dtype="float32")
+            values[frame_idx, station_idx] = group_by_geo_df[metric].to_numpy()
+            self.values[metric] = values
+        self.max = {metric: float(np.nanmax(values)) if values.size else 0. for metric, values in self.values.items()}
+        self.abs_max = {metric: float(np.nanmax(np.abs(values))) if values.size else 0.
+                        for metric, values in self.values.items()}
+
+    def __len__(self):
+        return len(self.day_hours)
+
+    def labels(self, in_french):
+        return self.labels_fr if in_french else self.labels_en
+
+    def frame(self, metric, frame):
+        return self.values[metric][frame]
+
+    def sizes(self, metric, frame):
+        # Marker sizes can not be negative (diff metrics) nor missing
+        return np.nan_to_num(np.abs(self.values[metric][frame]))
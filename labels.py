@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+
+from aggregates import N_SLOTS, TIME_VARIABLE, slot_to_day_hour
+
+# Spelled out here rather than taken from the process locale, which is global and may be missing on the host
+DAYS_FR = ["lundi", "mardi", "mercredi", "jeudi", "vendredi", "samedi", "dimanche"]
+DAYS_EN = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+MONTHS_FR = ["janvier", "février", "mars", "avril", "mai", "juin", "juillet", "août", "septembre", "octobre",
+             "novembre", "décembre"]
+MONTHS_EN = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October",
+             "November", "December"]
+
+LABEL_COLUMNS = ["Jour et heure", "Time"]
+
+
+def _label_fr(slot):
+    # strftime("%A %Hh") in fr_FR
+    return "{} {:02d}h".format(DAYS_FR[slot // 24], slot % 24)
+
+
+def _label_en(slot):
+    # strftime("%A %I%p") in en_US
+    hour = slot % 24
+    return "{} {:02d}{}".format(DAYS_EN[slot // 24], hour % 12 or 12, "AM" if hour < 12 else "PM")
+
+
+# Indexed by slot, i.e. 24 * weekday + hour
+LABELS_FR = [_label_fr(slot) for slot in range(N_SLOTS)]
+LABELS_EN = [_label_en(slot) for slot in range(N_SLOTS)]
+
+
+def label_columns(slots):
+    return {"Jour et heure": pd.Categorical.from_codes(slots, LABELS_FR),
+            "Time": pd.Categorical.from_codes(slots, LABELS_EN)}
+
+
+def day_hour_labels():
+    slots = np.arange(N_SLOTS)
+    return pd.DataFrame({TIME_VARIABLE: slot_to_day_hour(slots), **label_columns(slots)})
+
+
+def format_last_updated(date, in_french):
+    if in_french:
+        return "Dernière mise à jour : {:02d} {} {} à {:02d}h{:02d}".format(date.day, MONTHS_FR[date.month - 1],
+                                                                           date.year, date.hour, date.minute)
+    return "Last updated : {} {:02d}, {} at {:02d}:{:02d}".format(MONTHS_EN[date.month - 1], date.day, date.year,
+                                                                  date.hour, date.minute)
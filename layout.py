@@ -23,6 +23,9 @@ LAYOUT = html.Div(children=[
                            persistence=True
                        ),
                        html.P(id="last-updated"),
+                       # Checks for the data refreshed in the background, every REFRESH_PERIOD of refresher.py
+                       dcc.Interval(id='refresh-interval', interval=60 * 1000),
+                       dcc.Store(id='data-version'),
                        ]),
 
     dcc.Markdown('''Lorem ipsum **dolor** sit _amet_, consectetur adipiscing elit. Donec orci nulla, congue eget 
@@ -47,6 +50,13 @@ LAYOUT = html.Div(children=[
                  html.Div(dcc.Graph(id='main-graphic'), style={'width': '60%', 'display': 'inline-block'}),
                  html.Div(dcc.Graph(id='specific-graphic'), style={'width': '40%', 'display': 'inline-block'}),
 
+                 html.Div(
+                     [html.Button('▶', id='play-button', n_clicks=0),
+                      html.Div(dcc.Slider(id='time-slider', min=0, max=0, step=1, value=0),
+                               style={'width': '90%', 'display': 'inline-block'}),
+                      dcc.Interval(id='play-interval', interval=1000, disabled=True)],
+                     id='time-controls', style={'width': '60%', 'display': 'none'}),
+
                  html.Div(
                      [html.Label('Mode'),
                       dcc.RadioItems(
@@ -56,6 +66,15 @@ LAYOUT = html.Div(children=[
                       )],
                      style={'width': '20%', 'display': 'inline-block'}),
 
+                 html.Div(
+                     [html.Label(id='render-label'),
+                      dcc.RadioItems(
+                          id='render-plot',
+                          value='Animation',
+                          persistence=True
+                      )],
+                     style={'width': '20%', 'display': 'inline-block'}),
+
                  html.Div(
                      [html.Div(className="row",
                                children=[html.Label(id="metrics-label"),
@@ -76,6 +95,18 @@ LAYOUT = html.Div(children=[
                           style={'width': '35%', 'display': 'inline-block'})
                       ], id="wrapper"),
 
+                 html.Div(
+                     [html.Label(id='nearby-label'),
+                      dcc.RadioItems(
+                          id='nearby-metric',
+                          value='num_bikes_available',
+                          inline=True,
+                          persistence=True
+                      ),
+                      html.Div(id='nearby-stations'),
+                      html.Div(id='station-forecast')],
+                     style={'width': '40%', 'display': 'inline-block', 'vertical-align': 'top'}),
+
                  dcc.Markdown('''
      ## Clustering
      Lorem ipsum **dolor** sit _amet_, consectetur adipiscing elit. Donec orci nulla, congue eget 
@@ -0,0 +1,230 @@
+import functools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from timeit import default_timer
+
+# Timing is on unless VELIB_METRICS=0, in which case the decorators return the functions unchanged. The sampling
+# profiler endpoint is only added with VELIB_PROFILER=1.
+ENABLED = os.environ.get("VELIB_METRICS", "1") != "0"
+PROFILER_ENABLED = os.environ.get("VELIB_PROFILER", "0") == "1"
+
+# Each gunicorn worker holds its own histograms. The web processes write them every FLUSH_PERIOD seconds to
+# METRICS_DIR/<pid of their master>/<pid>.json, and /metrics sums those of the workers of the same master, whichever
+# worker answers the scrape. The files of earlier runs, under another master, are left out.
+METRICS_DIR = os.environ.get("VELIB_METRICS_DIR") or os.path.join(tempfile.gettempdir(), "velib-metrics")
+FLUSH_PERIOD = 5
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(10 ** k for k in range(2, 9))
+
+PROFILE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 60
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    # Cumulative histogram in the Prometheus sense, one series per combination of label values
+
+    def __init__(self, name, documentation, labelnames=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            counts, total = self._series.get(labelvalues, ([0] * (len(self.buckets) + 1), 0.))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._series[labelvalues] = counts, total + value
+
+    def series(self):
+        with self._lock:
+            return {labelvalues: (list(counts), total) for labelvalues, (counts, total) in self._series.items()}
+
+    def expose(self, series=None):
+        # series defaults to those of this process
+        lines = ["# HELP {} {}".format(self.name, self.documentation), "# TYPE {} histogram".format(self.name)]
+        series = sorted((labelvalues, counts, total)
+                        for labelvalues, (counts, total) in (self.series() if series is None else series).items())
+        for labelvalues, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(self.name, _labels(self.labelnames, labelvalues, [("le", bound)]),
+                                                     cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _labels(self.labelnames, labelvalues), total))
+            lines.append("{}_count{} {}".format(self.name, _labels(self.labelnames, labelvalues), cumulative))
+        return "\n".join(lines)
+
+
+STAGE_SECONDS = Histogram("velib_stage_seconds", "Duration of the pipeline and figure stages", ["stage"])
+CALLBACK_SECONDS = Histogram("velib_callback_seconds", "Duration of the Dash callback functions", ["callback"])
+REQUEST_SECONDS = Histogram("velib_callback_request_seconds",
+                            "Duration of the Dash callback requests, JSON serialization included", ["output"])
+RESPONSE_BYTES = Histogram("velib_callback_response_bytes", "Size of the Dash callback responses", ["output"],
+                           BYTES_BUCKETS)
+REGISTRY = [STAGE_SECONDS, CALLBACK_SECONDS, REQUEST_SECONDS, RESPONSE_BYTES]
+
+
+class timed:
+    # Records the duration of a stage, either as a decorator or as a context manager:
+    #   @timed("preprocess")            with timed("history_series"):
+
+    def __init__(self, stage, histogram=STAGE_SECONDS):
+        self.stage = stage
+        self.histogram = histogram
+
+    def __call__(self, function):
+        if not ENABLED:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = default_timer()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.histogram.observe(default_timer() - start, self.stage)
+        return wrapper
+
+    def __enter__(self):
+        if ENABLED:
+            self._start = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        if ENABLED:
+            self.histogram.observe(default_timer() - self._start, self.stage)
+
+
+def timed_callback(function):
+    # Goes under @app.callback, the time of the JSON serialization being in the request metrics
+    return timed(function.__name__, CALLBACK_SECONDS)(function)
+
+
+def _workers_dir():
+    return os.path.join(METRICS_DIR, str(os.getppid()))
+
+
+def flush():
+    # Histograms of this process, to be summed with those of the other workers
+    directory = _workers_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "{}.json".format(os.getpid()))
+    with open(path + ".tmp", "w") as f:
+        json.dump({histogram.name: [[list(labelvalues), counts, total]
+                                    for labelvalues, (counts, total) in histogram.series().items()]
+                   for histogram in REGISTRY}, f)
+    os.replace(path + ".tmp", path)
+
+
+def merged_series():
+    # Sum over the workers, those which exited included, as the histograms are cumulative
+    flush()
+    merged = {histogram.name: {} for histogram in REGISTRY}
+    directory = _workers_dir()
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                worker = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for histogram_name, rows in worker.items():
+            series = merged.get(histogram_name)
+            if series is None:
+                continue
+            for labelvalues, counts, total in rows:
+                previous_counts, previous_total = series.get(tuple(labelvalues), ([0] * len(counts), 0.))
+                series[tuple(labelvalues)] = [a + b for a, b in zip(previous_counts, counts)], previous_total + total
+    return merged
+
+
+def expose():
+    merged = merged_series()
+    return "\n".join(histogram.expose(merged[histogram.name]) for histogram in REGISTRY) + "\n"
+
+
+def flush_periodically(period=FLUSH_PERIOD):
+    def run():
+        while True:
+            time.sleep(period)
+            try:
+                flush()
+            except OSError as e:
+                print("Metrics flush failed: {}".format(e))
+
+    thread = threading.Thread(target=run, name="metrics-flush", daemon=True)
+    thread.start()
+    return thread
+
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL):
+    # Poor man's sampling profiler: the stacks of every other thread, in the collapsed format of flamegraph.pl
+    stacks = Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            names = []
+            while frame is not None:
+                names.append("{}:{}".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                frame = frame.f_back
+            stacks[";".join(reversed(names))] += 1
+        time.sleep(interval)
+    return "\n".join("{} {}".format(stack, count) for stack, count in stacks.most_common()) + "\n"
+
+
+def register(server):
+    # /metrics on the Flask server of the app, plus the request hooks timing the callback responses. /metrics sums
+    # the histograms of all the workers, see METRICS_DIR, while /metrics/profile samples the one worker answering.
+    from flask import Response, g, request
+
+    @server.route("/metrics")
+    def metrics():
+        return Response(expose(), mimetype="text/plain; version=0.0.4")
+
+    if PROFILER_ENABLED:
+        @server.route("/metrics/profile")
+        def profile():
+            seconds = min(float(request.args.get("seconds", 5)), MAX_PROFILE_SECONDS)
+            return Response(sample_stacks(seconds), mimetype="text/plain")
+
+    if not ENABLED:
+        return
+    flush_periodically()
+
+    @server.before_request
+    def start_timer():
+        g.metrics_start = default_timer()
+
+    @server.after_request
+    def record_callback(response):
+        if request.path.endswith("_dash-update-component") and "metrics_start" in g:
+            output = (request.get_json(silent=True) or {}).get("output", "")
+            REQUEST_SECONDS.observe(default_timer() - g.metrics_start, output)
+            RESPONSE_BYTES.observe(response.calculate_content_length() or 0, output)
+        return response
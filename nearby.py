@@ -0,0 +1,154 @@
+import os
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from stations import INFORMATION_PATH, load_stations
+from storage import POLL_FORMAT, SNAPSHOT_DIR, list_snapshots, load_snapshot
+
+EARTH_RADIUS = 6371000.
+
+# Last known counts kept per station, and the short names the API takes for them
+COUNTS = ['num_bikes_available', 'num_ebikes_available', 'num_mech_bikes_available', 'num_docks_available']
+QUERY_METRICS = {"bikes": "num_bikes_available", "ebikes": "num_ebikes_available",
+                 "mech_bikes": "num_mech_bikes_available", "docks": "num_docks_available"}
+DEFAULT_K = 5
+MAX_K = 50
+# Polls read back for the stations missing from the latest ones, which then count as having nothing available
+LOOKBACK = pd.Timedelta(days=1)
+
+# One immutable version of the index, swapped as a whole so that a query never mixes two of them
+_Index = namedtuple("_Index", ["stations_df", "tree", "station_ids", "rows", "names", "lat", "lon", "counts",
+                               "renting", "returning", "snapshot_path", "date"])
+
+
+def poll_date(path):
+    return datetime.strptime(os.path.basename(path)[:-len(".npz")], POLL_FORMAT)
+
+
+def unit_vectors(lat, lon):
+    # Points of the unit sphere, whose chord distances are in the same order as the great-circle ones
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+class NearbyStations:
+    # KD-tree over the coordinates of station_information on the unit sphere, rebuilt only when the file changes,
+    # with the last known counts of every station in arrays aligned with it. sklearn's haversine BallTree gives the
+    # same neighbours but its input validation alone takes 100us a query.
+
+    def __init__(self, information_path=INFORMATION_PATH, snapshot_dir=SNAPSHOT_DIR):
+        self.information_path = information_path
+        self.snapshot_dir = snapshot_dir
+        self._index = None
+        self.refresh()
+
+    def refresh(self):
+        index = self._index
+        stations_df = load_stations(self.information_path, refresh=False)
+        if index is None or index.stations_df is not stations_df:
+            station_ids = stations_df.index.to_numpy()
+            lat, lon = stations_df.lat.to_numpy(dtype="float64"), stations_df.lon.to_numpy(dtype="float64")
+            index = _Index(stations_df, cKDTree(unit_vectors(lat, lon)),
+                           station_ids, {id_: row for row, id_ in enumerate(station_ids.tolist())},
+                           stations_df.name.to_numpy(), lat, lon, None, None, None, None, None)
+
+        if index.date is None:
+            # The counts of a new index are read back over the last LOOKBACK of polls
+            paths = list_snapshots(self.snapshot_dir)
+            if paths:
+                newest = poll_date(paths[-1])
+                paths = [path for path in paths if poll_date(path) >= newest - LOOKBACK]
+        else:
+            paths = list_snapshots(self.snapshot_dir, start=index.date + pd.Timedelta(seconds=1))
+        if paths or index.counts is None:
+            index = self._join_counts(index, paths[::-1])
+        self._index = index
+        return index
+
+    def _join_counts(self, index, paths):
+        # paths from the newest one, each station taking its counts from the newest poll it is in. With the
+        # collector's --dedupe, a poll only holds the stations whose last_reported changed, so the others keep the
+        # counts they had. Stations in none of them have nothing available.
+        n_stations = len(index.station_ids)
+        if index.counts is None:
+            counts = np.zeros((n_stations, len(COUNTS)), dtype="int16")
+            renting, returning = np.zeros(n_stations, dtype=bool), np.zeros(n_stations, dtype=bool)
+        else:
+            counts, renting, returning = index.counts.copy(), index.renting.copy(), index.returning.copy()
+
+        seen = np.zeros(n_stations, dtype=bool)
+        date = index.date
+        for path in paths:
+            poll = load_snapshot(path, ["station_id", "is_renting", "is_returning", "date_retrieved"] + COUNTS)
+            rows = np.array([index.rows.get(id_, -1) for id_ in poll.station_id.tolist()], dtype="int64")
+            fresh = rows >= 0
+            fresh[fresh] = ~seen[rows[fresh]]
+            counts[rows[fresh]] = poll[COUNTS].to_numpy()[fresh]
+            renting[rows[fresh]] = poll.is_renting.to_numpy()[fresh] == 1
+            returning[rows[fresh]] = poll.is_returning.to_numpy()[fresh] == 1
+            seen[rows[fresh]] = True
+            if len(poll) and (date is None or poll.date_retrieved.max() > date):
+                date = poll.date_retrieved.max()
+            if seen.all():
+                break
+        return index._replace(counts=counts, renting=renting, returning=returning,
+                              snapshot_path=paths[0] if paths else index.snapshot_path, date=date)
+
+    @property
+    def date(self):
+        return self._index.date
+
+    def coordinates(self, station_id):
+        index = self._index
+        row = index.rows.get(station_id)
+        return None if row is None else (index.lat[row], index.lon[row])
+
+    def nearest(self, lat, lon, k=DEFAULT_K, metric="num_bikes_available", minimum=1):
+        # The k closest stations with at least minimum of metric in their last known counts, bikes only counting at
+        # renting stations and docks at returning ones. Candidates are queried 4k at a time until enough are available.
+        index = self._index
+        n_stations = len(index.station_ids)
+        k = min(k, n_stations)
+        if k <= 0:
+            return []
+        m = COUNTS.index(metric)
+        open_ = index.returning if metric == "num_docks_available" else index.renting
+        point = unit_vectors(lat, lon)
+
+        n_candidates = min(4 * k, n_stations)
+        while True:
+            chords, rows = index.tree.query(point, k=n_candidates)
+            chords, rows = np.atleast_1d(chords), np.atleast_1d(rows)
+            keep = open_[rows] & (index.counts[rows, m] >= minimum)
+            if keep.sum() >= k or n_candidates == n_stations:
+                break
+            n_candidates = min(4 * n_candidates, n_stations)
+
+        rows, distances = rows[keep][:k], 2 * EARTH_RADIUS * np.arcsin(np.minimum(chords[keep][:k] / 2, 1))
+        return [dict({"station_id": int(index.station_ids[row]), "name": str(index.names[row]),
+                      "lat": float(index.lat[row]), "lon": float(index.lon[row]), "distance_m": round(float(d))},
+                     **{c: int(index.counts[row, i]) for i, c in enumerate(COUNTS)})
+                for row, d in zip(rows, distances)]
+
+
+def register(server, nearby):
+    # GET /api/nearest?lat=48.85&lon=2.35&k=5&metric=ebikes&min=2
+    from flask import jsonify, request
+
+    @server.route("/api/nearest")
+    def nearest():
+        try:
+            lat, lon = float(request.args["lat"]), float(request.args["lon"])
+            k = min(int(request.args.get("k", DEFAULT_K)), MAX_K)
+            minimum = int(request.args.get("min", 1))
+            metric = QUERY_METRICS[request.args.get("metric", "bikes")]
+        except (KeyError, ValueError):
+            return jsonify({"error": "expects lat, lon and optionally k (at most {}), min and metric among {}".format(
+                MAX_K, ", ".join(QUERY_METRICS))}), 400
+        date = nearby.date
+        return jsonify({"date": None if date is None else str(date),
+                        "stations": nearby.nearest(lat, lon, k, metric, minimum)})
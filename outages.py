@@ -0,0 +1,221 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from aggregates import AGGREGATES_PATH, AggregateState
+from stations import INFORMATION_PATH, load_stations
+from storage import CHUNK_POLLS, SNAPSHOT_DIR, iter_snapshot_chunks
+
+DETECTOR_PATH = "outages.npz"
+EVENTS_PATH = "station_events.csv"
+
+KINDS = ["stale", "frozen", "inconsistent", "flapping"]
+COUNT_COLUMNS = ['num_bikes_available', 'num_mech_bikes_available', 'num_ebikes_available', 'num_docks_available']
+DETECTOR_COLUMNS = ['station_id', 'date_retrieved', 'legible_last_reported', 'is_renting'] + COUNT_COLUMNS
+
+# stale: the station has not reported for this long
+STALE_SECONDS = 2 * 3600
+# frozen: a renting station whose counts have not moved for this long, longer than a quiet night
+FROZEN_SECONDS = 12 * 3600
+# flapping: decayed count of the is_renting switches, with this half-life, above FLAP_ON and until it is below FLAP_OFF
+FLAP_HALF_LIFE = 2 * 3600
+FLAP_ON = 3
+FLAP_OFF = 1
+
+# Seconds of the intervals still open, and bits of the seconds in the (station, seconds) keys
+OPEN = 2 ** 34 - 1
+
+
+def _seconds(dates):
+    # Epoch seconds of datetimes, or of the uint32 seconds of the compact history
+    dates = np.asarray(dates)
+    if dates.dtype.kind in "iu":
+        return dates.astype("int64")
+    return pd.to_datetime(dates).to_numpy().astype("datetime64[s]").astype("int64")
+
+
+class OutageDetector:
+    # Online detector of the stations whose polls should not be trusted, fed with every poll by the collector. The
+    # state is a few numbers per station: last counts and when they last changed, last is_renting, decayed number of
+    # its switches and the current flags, one per kind. Flags switching on and off are the events.
+
+    def __init__(self, station_ids=None, counts=None, changed_at=None, renting=None, seen_at=None, flaps=None,
+                 flags=None):
+        n_stations = 0 if station_ids is None else len(station_ids)
+        self.station_ids = np.zeros(0, dtype="int64") if station_ids is None else station_ids
+        self.counts = np.full((n_stations, len(COUNT_COLUMNS)), -1, dtype="int64") if counts is None else counts
+        self.changed_at = np.zeros(n_stations, dtype="int64") if changed_at is None else changed_at
+        self.renting = np.full(n_stations, -1, dtype="int8") if renting is None else renting
+        self.seen_at = np.zeros(n_stations, dtype="int64") if seen_at is None else seen_at
+        self.flaps = np.zeros(n_stations) if flaps is None else flaps
+        self.flags = np.zeros((n_stations, len(KINDS)), dtype=bool) if flags is None else flags
+        self._rows = {id_: row for row, id_ in enumerate(self.station_ids.tolist())}
+
+    def _station_rows(self, station_ids):
+        new_ids = [id_ for id_ in pd.unique(station_ids) if id_ not in self._rows]
+        if new_ids:
+            n_new = len(new_ids)
+            for id_ in new_ids:
+                self._rows[id_] = len(self._rows)
+            self.station_ids = np.concatenate([self.station_ids, np.asarray(new_ids, dtype="int64")])
+            self.counts = np.concatenate([self.counts, np.full((n_new, len(COUNT_COLUMNS)), -1, dtype="int64")])
+            self.changed_at = np.concatenate([self.changed_at, np.zeros(n_new, dtype="int64")])
+            self.renting = np.concatenate([self.renting, np.full(n_new, -1, dtype="int8")])
+            self.seen_at = np.concatenate([self.seen_at, np.zeros(n_new, dtype="int64")])
+            self.flaps = np.concatenate([self.flaps, np.zeros(n_new)])
+            self.flags = np.concatenate([self.flags, np.zeros((n_new, len(KINDS)), dtype=bool)])
+        return np.array([self._rows[id_] for id_ in station_ids], dtype="int64")
+
+    def update(self, poll, capacity):
+        # poll holds one row per station of a single poll, capacity is indexed by station_id. Returns the events.
+        station_ids = poll.station_id.to_numpy()
+        rows = self._station_rows(station_ids)
+        date = pd.Timestamp(poll.date_retrieved.iloc[0]) if len(poll) else None
+        now = _seconds([date])[0] if len(poll) else 0
+
+        counts = poll[COUNT_COLUMNS].to_numpy(dtype="int64")
+        changed = (counts != self.counts[rows]).any(axis=1)
+        self.changed_at[rows[changed]] = now
+        self.counts[rows] = counts
+
+        renting = poll.is_renting.to_numpy().astype("int8")
+        switched = (self.renting[rows] >= 0) & (renting != self.renting[rows])
+        decay = 0.5 ** ((now - self.seen_at[rows]) / FLAP_HALF_LIFE)
+        self.flaps[rows] = self.flaps[rows] * decay + switched
+        self.renting[rows] = renting
+        self.seen_at[rows] = now
+
+        station_capacity = capacity.reindex(station_ids).to_numpy(dtype="float64")
+        was_flapping = self.flags[rows, KINDS.index("flapping")]
+        flags = np.column_stack([
+            now - _seconds(poll.legible_last_reported) > STALE_SECONDS,
+            (renting == 1) & (now - self.changed_at[rows] > FROZEN_SECONDS),
+            (counts[:, 0] + counts[:, 3] > station_capacity) | (counts[:, 1] + counts[:, 2] != counts[:, 0]),
+            self.flaps[rows] >= np.where(was_flapping, FLAP_OFF, FLAP_ON),
+        ])
+
+        started, ended = flags & ~self.flags[rows], ~flags & self.flags[rows]
+        self.flags[rows] = flags
+        events = []
+        for event, switched_flags in [("start", started), ("end", ended)]:
+            station_idx, kinds = np.nonzero(switched_flags)
+            events.append(pd.DataFrame({"date": date, "station_id": station_ids[station_idx],
+                                        "kind": np.array(KINDS)[kinds], "event": event}))
+        return pd.concat(events, ignore_index=True)
+
+    def mask(self, station_ids, dates=None):
+        # Rows of the stations currently flagged, for the poll that was just fed in
+        rows = np.array([self._rows.get(id_, -1) for id_ in np.asarray(station_ids).tolist()], dtype="int64")
+        flagged = self.flags.any(axis=1)
+        return (rows >= 0) & flagged[np.maximum(rows, 0)] if len(flagged) else np.zeros(len(rows), dtype=bool)
+
+    def save(self, path=DETECTOR_PATH):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, station_ids=self.station_ids, counts=self.counts, changed_at=self.changed_at,
+                     renting=self.renting, seen_at=self.seen_at, flaps=self.flaps, flags=self.flags)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path=DETECTOR_PATH):
+        if not os.path.exists(path):
+            return cls()
+        with np.load(path) as data:
+            return cls(data["station_ids"], data["counts"], data["changed_at"], data["renting"], data["seen_at"],
+                       data["flaps"], data["flags"])
+
+
+def record_events(events, path=EVENTS_PATH):
+    if len(events):
+        events.to_csv(path, mode="a", header=not os.path.exists(path), index=False,
+                      date_format="%Y-%m-%d %H:%M:%S")
+    return events
+
+
+def read_events(path=EVENTS_PATH):
+    if not os.path.exists(path):
+        return pd.DataFrame({"date": pd.Series(dtype="datetime64[s]"), "station_id": pd.Series(dtype="int64"),
+                             "kind": pd.Series(dtype="str"), "event": pd.Series(dtype="str")})
+    return pd.read_csv(path, parse_dates=["date"])
+
+
+class Exclusions:
+    # Time intervals [start, end) over which the polls of a station are left out of the aggregates and clustering,
+    # from the events of the detector. A station is excluded from the poll its first flag switches on until the one
+    # where its last flag switches off, as the collector does online, so batch and online aggregates agree.
+
+    def __init__(self, events):
+        events = events.sort_values(["station_id", "kind", "date"], kind="stable")
+        ends = events.groupby(["station_id", "kind"]).date.shift(-1)
+        is_start = (events.event == "start").to_numpy()
+        stations = events.station_id.to_numpy()[is_start]
+        starts = _seconds(events.date)[is_start]
+        ends = np.where(ends.isna(), OPEN, _seconds(ends.fillna(events.date)))[is_start]
+
+        # Overlapping intervals of the different kinds of a station are merged
+        order = np.lexsort((starts, stations))
+        stations, starts, ends = stations[order], starts[order], ends[order]
+        reach = pd.Series(ends).groupby(stations).cummax().to_numpy()
+        first = np.append(True, (stations[1:] != stations[:-1]) | (starts[1:] > reach[:-1])) if len(stations) \
+            else np.zeros(0, dtype=bool)
+        merged_ends = np.maximum.reduceat(ends, np.flatnonzero(first)) if len(stations) else ends
+
+        self.stations = np.unique(stations)
+        rank = np.searchsorted(self.stations, stations[first])
+        self.starts = (rank << 34) + starts[first]
+        self.ends = (rank << 34) + merged_ends
+        self.open_stations = stations[first][merged_ends == OPEN]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def mask(self, station_ids, dates):
+        # Rows falling in an interval of their station, by a single sorted search on (station rank, seconds) keys
+        station_ids = np.asarray(station_ids)
+        if not len(self) or not len(station_ids):
+            return np.zeros(len(station_ids), dtype=bool)
+        rank = np.minimum(np.searchsorted(self.stations, station_ids), len(self.stations) - 1)
+        keys = (rank << 34) + _seconds(dates)
+        interval = np.searchsorted(self.starts, keys, side="right") - 1
+        return ((self.stations[rank] == station_ids) & (interval >= 0)
+                & (keys < self.ends[np.maximum(interval, 0)]))
+
+    @classmethod
+    def load(cls, path=EVENTS_PATH):
+        return cls(read_events(path))
+
+
+def replay(snapshot_dir=SNAPSHOT_DIR, information_path=INFORMATION_PATH, detector_path=DETECTOR_PATH,
+           events_path=EVENTS_PATH, state_path=AGGREGATES_PATH, chunk_polls=CHUNK_POLLS):
+    # Runs the detector over the whole store, for a history collected before it, then folds the aggregates again
+    # without the excluded polls. The artifacts then need a full build.
+    capacity = load_stations(information_path).capacity
+    detector = OutageDetector()
+    if os.path.exists(events_path):
+        os.remove(events_path)
+    n_events = 0
+    for chunk in iter_snapshot_chunks(snapshot_dir, columns=DETECTOR_COLUMNS, chunk_polls=chunk_polls):
+        for _, poll in chunk.groupby("date_retrieved", sort=True):
+            n_events += len(record_events(detector.update(poll, capacity), events_path))
+    detector.save(detector_path)
+
+    state = AggregateState()
+    state.update_from_store(snapshot_dir, exclusions=Exclusions.load(events_path))
+    state.save(state_path)
+    return n_events
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Station outages detected in the polls")
+    parser.add_argument("--replay", action="store_true",
+                        help="Detect them over the whole snapshot store and fold the aggregates again without them")
+    parser.add_argument("--snapshot-dir", default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    if args.replay:
+        print("{} events written to {}".format(replay(args.snapshot_dir), EVENTS_PATH))
+    events = read_events()
+    print(events.groupby(["kind", "event"]).size().to_string() if len(events) else "No events")
+    print("{} stations currently excluded".format(len(Exclusions(events).open_stations)))
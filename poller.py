@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+import os
+import random
+from datetime import datetime
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from aggregates import AGGREGATES_PATH, AggregateState
+from api_calls import INFORMATION_URL, STATUS_URL, status_to_frame
+from forecasting import FORECASTS_PATH, refresh_forecasts
+from outages import DETECTOR_PATH, EVENTS_PATH, Exclusions, OutageDetector, record_events
+from stations import HISTORY_PATH, INFORMATION_PATH, TTL, load_stations, refresh_station_information
+from storage import SNAPSHOT_DIR, write_snapshot
+
+MIN_PERIOD = 30
+
+
+def modified_at(path):
+    return os.stat(path).st_mtime_ns if os.path.exists(path) else None
+
+
+class Collector:
+    def __init__(self, period=15 * 60, status_url=STATUS_URL, information_url=INFORMATION_URL, root=SNAPSHOT_DIR,
+                 state_path=AGGREGATES_PATH, information_path=INFORMATION_PATH, history_path=HISTORY_PATH,
+                 forecasts_path=FORECASTS_PATH, detector_path=DETECTOR_PATH, events_path=EVENTS_PATH,
+                 information_ttl=TTL, dedupe=False, timeout=10, max_retries=5, backoff=1.0, max_backoff=60.0):
+        if period < MIN_PERIOD:
+            raise ValueError("The polling period must be at least {} seconds, got {}".format(MIN_PERIOD, period))
+        self.period = period
+        self.status_url = status_url
+        self.information_url = information_url
+        self.root = root
+        self.state_path = state_path
+        self.information_path = information_path
+        self.history_path = history_path
+        self.forecasts_path = forecasts_path
+        self.detector_path = detector_path
+        self.events_path = events_path
+        self.information_ttl = information_ttl
+        self.dedupe = dedupe
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # Both feeds are fetched over the same pool of keep-alive connections
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.load_state()
+        self.detector = OutageDetector.load(detector_path)
+        self.last_reported = pd.Series(dtype="float64")
+
+    def load_state(self):
+        self.state = AggregateState.load(self.state_path)
+        # Polls stored before the state, e.g. on a first deploy or after a migration, are folded in before any new one
+        n_polls = self.state.update_from_store(self.root, exclusions=Exclusions.load(self.events_path))
+        if n_polls:
+            self.state.save(self.state_path)
+            print("{} stored polls folded into {}".format(n_polls, self.state_path))
+        self.state_modified_at = modified_at(self.state_path)
+
+    def _get_json(self, url):
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def _refresh_information(self):
+        return refresh_station_information(self.session, self.information_url, self.information_path,
+                                           self.history_path, self.information_ttl, timeout=self.timeout)
+
+    async def retrying(self, function, *args):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await loop.run_in_executor(None, function, *args)
+            except (requests.RequestException, ValueError) as e:
+                if attempt == self.max_retries:
+                    raise
+                # Exponential backoff with full jitter
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                print("Request failed ({}), retrying in {:.1f}s".format(e, delay))
+                await asyncio.sleep(delay)
+
+    def deduplicate(self, df):
+        # Rows of stations that have not reported since the previous poll carry no new information
+        previous = self.last_reported.reindex(df.station_id.to_numpy()).to_numpy()
+        current = pd.Series(df.last_reported.to_numpy(dtype="float64"), index=df.station_id.to_numpy())
+        self.last_reported = current.combine_first(self.last_reported)
+        return df[df.last_reported.to_numpy() != previous]
+
+    def process(self, status, date_retrieved):
+        poll = status_to_frame(status, date_retrieved)
+        # The detector sees every station, the ones flagged after this poll are left out of the aggregates
+        events = self.detector.update(poll, load_stations(self.information_path).capacity)
+        record_events(events, self.events_path)
+        self.detector.save(self.detector_path)
+        for kind, n_stations in events[events.event == "start"].kind.value_counts().items():
+            print("{} stations {}".format(n_stations, kind))
+        df = self.deduplicate(poll) if self.dedupe else poll
+
+        if len(df):
+            # Aggregates rewritten by a build in the meantime are reloaded rather than overwritten
+            if modified_at(self.state_path) != self.state_modified_at:
+                self.load_state()
+            write_snapshot(df, self.root)
+            self.state.update(df, self.detector)
+            self.state.save(self.state_path)
+            self.state_modified_at = modified_at(self.state_path)
+        # From the whole poll, the stations left out by the deduplication being as they were
+        refresh_forecasts(poll, self.forecasts_path)
+        return len(df)
+
+    async def poll(self):
+        date_retrieved = datetime.now()
+        # station_information is only revalidated once its cached copy is older than the TTL
+        status, _ = await asyncio.gather(self.retrying(self._get_json, self.status_url),
+                                         self.retrying(self._refresh_information))
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.process, status, date_retrieved)
+
+    async def run(self, n_polls=None):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        tick, done = 0, 0
+        while True:
+            try:
+                n_rows = await self.poll()
+                print("{} rows written at {}".format(n_rows, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            except Exception as e:
+                print("Poll failed: {!r}".format(e))
+            done += 1
+            if n_polls is not None and done >= n_polls:
+                break
+
+            # Ticks are counted from the start so that the cadence does not drift, and the ones missed are skipped
+            tick = max(tick + 1, int((loop.time() - start) // self.period) + 1)
+            await asyncio.sleep(start + tick * self.period - loop.time())
+        self.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Poll the Velib feeds into the snapshot store")
+    parser.add_argument("--period", type=float, default=15 * 60, help="Seconds between polls")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="Only store the stations whose last_reported changed since the previous poll")
+    parser.add_argument("--root", default=SNAPSHOT_DIR)
+    parser.add_argument("--status-url", default=STATUS_URL)
+    parser.add_argument("--information-url", default=INFORMATION_URL)
+    args = parser.parse_args()
+
+    collector = Collector(period=args.period, status_url=args.status_url, information_url=args.information_url,
+                          root=args.root, dedupe=args.dedupe)
+    asyncio.run(collector.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import threading
+
+import pandas as pd
+
+from artifacts import ARTIFACTS_DIR, Artifacts, build_lock, current_version
+from build import build_incremental
+from metrics import timed
+from storage import SNAPSHOT_DIR, list_snapshots
+
+REFRESH_PERIOD = 60
+
+
+class Refresher:
+    # Background thread keeping the served artifacts up to date with the snapshot store. When new polls are found,
+    # one process folds them into a new version (the others skip while it holds the build lock), and every process
+    # loads the published version and hands it to on_swap as soon as it sees it.
+
+    def __init__(self, artifacts, on_swap, period=REFRESH_PERIOD, snapshot_dir=SNAPSHOT_DIR,
+                 artifacts_dir=ARTIFACTS_DIR):
+        self.directory = artifacts.directory
+        self.date_last_updated = artifacts.date_last_updated
+        self.on_swap = on_swap
+        self.period = period
+        self.snapshot_dir = snapshot_dir
+        self.artifacts_dir = artifacts_dir
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self):
+        if list_snapshots(self.snapshot_dir, start=self.date_last_updated + pd.Timedelta(seconds=1)):
+            with build_lock(self.artifacts_dir, blocking=False) as locked:
+                if locked:
+                    # A full build would load the whole history in this worker
+                    build_incremental(self.snapshot_dir, self.artifacts_dir, full_fallback=False)
+
+        version_dir = current_version(self.artifacts_dir)
+        if version_dir is None or version_dir == self.directory:
+            return False
+
+        with timed("load_artifacts"):
+            artifacts = Artifacts(version_dir)
+        self.directory, self.date_last_updated = version_dir, artifacts.date_last_updated
+        self.on_swap(artifacts)
+        print("Swapped in the artifacts of {}".format(self.date_last_updated))
+        return True
+
+    def run(self):
+        while not self._stop.wait(self.period):
+            try:
+                self.check()
+            except Exception as e:
+                print("Refresh failed: {}".format(e))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="artifacts-refresher", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,69 @@
+import pandas as pd
+
+# Compact in-memory types of the history frame returned by preprocess. Columns which are not listed, the duplicated
+# merge keys and the raw list of rental methods, are dropped.
+#   unsigned / signed: smallest integer type holding the values, uint8 or uint16 for the counts
+#   float32: ratios and coordinates
+#   category: repeated strings
+#   epoch: timestamps as uint32 seconds since the epoch, which can be cast back with .astype("datetime64[s]")
+HISTORY_SCHEMA = {
+    "station_id": "unsigned",
+    "num_bikes_available": "unsigned",
+    "num_docks_available": "unsigned",
+    "is_installed": "unsigned",
+    "is_returning": "unsigned",
+    "is_renting": "unsigned",
+    "last_reported": "unsigned",
+    "num_mech_bikes_available": "unsigned",
+    "num_ebikes_available": "unsigned",
+    "legible_last_reported": "epoch",
+    "functioning_word": "category",
+    "lastUpdated": "epoch",
+    "date_retrieved": "epoch",
+    "day_hour_of_week_num": "unsigned",
+    "hour_num": "unsigned",
+    "Jour et heure": "category",
+    "Time": "category",
+    "name": "category",
+    "lat": "float32",
+    "lon": "float32",
+    "capacity": "unsigned",
+    "rental_methods_str": "category",
+    "diff_ebikes": "signed",
+    "diff_mech_bikes": "signed",
+    "diff_bikes": "signed",
+    "occupancy": "float32",
+    "occupancy_mech": "float32",
+    "occupancy_ebikes": "float32",
+    "frac_mech": "float32",
+    "frac_ebikes": "float32",
+}
+
+
+def compact_column(values, kind):
+    if kind == "unsigned":
+        return pd.to_numeric(values, downcast="unsigned")
+    if kind == "signed":
+        return pd.to_numeric(values, downcast="integer")
+    if kind == "epoch":
+        return pd.Series(values.to_numpy().astype("datetime64[s]").astype("int64").astype("uint32"),
+                         index=values.index)
+    if kind == "category":
+        return values if isinstance(values.dtype, pd.CategoricalDtype) else values.astype("category")
+    return values.astype(kind)
+
+
+def compact_history(df, schema=HISTORY_SCHEMA):
+    # Expects the missing values to be filled already, except in the label columns
+    return pd.DataFrame({c: compact_column(df[c], kind) for c, kind in schema.items() if c in df.columns},
+                        copy=False)
+
+
+def memory_report(before, after):
+    before_bytes = before.memory_usage(deep=True).sum()
+    after_bytes = after.memory_usage(deep=True).sum()
+    n_rows = max(len(after), 1)
+    print("History frame: {:.1f} MB -> {:.1f} MB ({:.0f} -> {:.0f} bytes per row, {} -> {} columns)".format(
+        before_bytes / 1e6, after_bytes / 1e6, before_bytes / n_rows, after_bytes / n_rows,
+        before.shape[1], after.shape[1]))
+    return before_bytes, after_bytes
@@ -0,0 +1,25 @@
+import numpy as np
+
+
+class StationIndex:
+    # Rows of a frame reordered so that each station is one contiguous slice, looked up by station_id in O(1).
+    # Within a station the rows keep the order of sort_by.
+
+    def __init__(self, df, sort_by=None):
+        if sort_by is not None:
+            order = np.lexsort((df[sort_by].to_numpy(), df.station_id.to_numpy()))
+        else:
+            order = np.argsort(df.station_id.to_numpy(), kind="stable")
+        self.df = df.iloc[order].reset_index(drop=True)
+
+        station_ids = self.df.station_id.to_numpy()
+        unique_ids, starts = np.unique(station_ids, return_index=True)
+        stops = np.append(starts[1:], len(station_ids))
+        self.bounds = {id_: (start, stop) for id_, start, stop in zip(unique_ids.tolist(), starts, stops)}
+
+    def __contains__(self, station_id):
+        return station_id in self.bounds
+
+    def rows(self, station_id):
+        start, stop = self.bounds.get(station_id, (0, 0))
+        return self.df.iloc[start:stop]
@@ -0,0 +1,113 @@
+import json
+import os
+import time
+from datetime import datetime
+
+import pandas as pd
+import requests
+
+from api_calls import INFORMATION_URL
+
+INFORMATION_PATH = "station_information.json"
+HISTORY_PATH = "station_history.csv"
+
+# Seconds before the cached station_information is revalidated against the API
+TTL = 60 * 60
+
+TRACKED = ['name', 'lat', 'lon', 'capacity']
+
+_loaded = {}
+
+
+def _meta_path(path):
+    return os.path.splitext(path)[0] + ".meta.json"
+
+
+def _write_json(data, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_meta(path=INFORMATION_PATH):
+    if not os.path.exists(_meta_path(path)):
+        return {}
+    with open(_meta_path(path)) as f:
+        return json.load(f)
+
+
+def stations_to_frame(information):
+    df = pd.DataFrame(information["data"]["stations"])
+    df["rental_methods_str"] = df.rental_methods.str[0].fillna("Aucun")
+    return df
+
+
+def record_changes(previous, current, date, history_path=HISTORY_PATH):
+    previous = previous.set_index("station_id")[TRACKED]
+    current = current.set_index("station_id")[TRACKED]
+
+    added = current.loc[current.index.difference(previous.index)].assign(change="added")
+    removed = previous.loc[previous.index.difference(current.index)].assign(change="removed")
+    common = current.index.intersection(previous.index)
+    modified = (current.loc[common] != previous.loc[common]).any(axis=1)
+    modified = current.loc[modified[modified].index].assign(change="modified")
+
+    changes = pd.concat([added, removed, modified]).reset_index()
+    if len(changes):
+        changes.insert(0, "date", date.strftime("%Y-%m-%d %H:%M:%S"))
+        changes.to_csv(history_path, mode="a", header=not os.path.exists(history_path), index=False)
+    return changes
+
+
+def refresh_station_information(session=None, url=INFORMATION_URL, path=INFORMATION_PATH, history_path=HISTORY_PATH,
+                                ttl=TTL, force=False, timeout=10):
+    meta = read_meta(path)
+    if not force and os.path.exists(path) and time.time() < meta.get("fetched_at", 0) + ttl:
+        return False
+
+    # Conditional request, so that an unchanged station list costs a 304 without a body
+    headers = {}
+    if os.path.exists(path):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    response = (session or requests).get(url, headers=headers, timeout=timeout)
+    response.raise_for_status()
+    meta["fetched_at"] = time.time()
+    if response.status_code == 304:
+        _write_json(meta, _meta_path(path))
+        return False
+
+    information = response.json()
+    current = stations_to_frame(information)
+    previous = load_stations(path, refresh=False).reset_index() if os.path.exists(path) else current.iloc[:0]
+    record_changes(previous, current, datetime.now(), history_path)
+
+    meta["etag"] = response.headers.get("ETag")
+    meta["last_modified"] = response.headers.get("Last-Modified")
+    _write_json(information, path)
+    _write_json(meta, _meta_path(path))
+    return True
+
+
+def load_stations(path=INFORMATION_PATH, refresh=True):
+    # Only the very first start, without any cached copy, needs the network
+    if refresh and not os.path.exists(path):
+        refresh_station_information(path=path, force=True)
+
+    # The table is indexed by station_id once per version of the file
+    mtime = os.path.getmtime(path)
+    if _loaded.get(path, (None,))[0] != mtime:
+        with open(path) as f:
+            stations_df = stations_to_frame(json.load(f))
+        _loaded[path] = mtime, stations_df.set_index("station_id").sort_index()
+    return _loaded[path][1]
+
+
+def read_history(history_path=HISTORY_PATH):
+    if not os.path.exists(history_path):
+        return pd.DataFrame(columns=["date", "station_id"] + TRACKED + ["change"])
+    return pd.read_csv(history_path, parse_dates=["date"])
@@ -0,0 +1,167 @@
+import argparse
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+SNAPSHOT_DIR = "snapshots"
+NAME_CSV = "velib_data_with_date.csv"
+
+# One compressed .npz per poll, partitioned by day: snapshots/2021-09-19/20210919T141500.npz
+DAY_FORMAT = "%Y-%m-%d"
+POLL_FORMAT = "%Y%m%dT%H%M%S"
+
+# Timestamps are naive local wall-clock times, as written by request_and_write
+SCHEMA = {
+    "stationCode": "U",
+    "station_id": "int64",
+    "num_bikes_available": "int16",
+    "num_docks_available": "int16",
+    "is_installed": "int8",
+    "is_returning": "int8",
+    "is_renting": "int8",
+    "last_reported": "int64",
+    "num_mech_bikes_available": "int16",
+    "num_ebikes_available": "int16",
+    "legible_last_reported": "datetime64[s]",
+    "functioning_word": "U",
+    "lastUpdated": "datetime64[s]",
+    "date_retrieved": "datetime64[s]",
+}
+COLUMNS = list(SCHEMA)
+DATE_COLUMNS = [c for c, t in SCHEMA.items() if t.startswith("datetime64")]
+
+# A week of polls every 15 minutes
+CHUNK_POLLS = 7 * 24 * 4
+
+
+def _to_array(series, dtype):
+    if dtype.startswith("datetime64"):
+        return pd.to_datetime(series).to_numpy().astype(dtype)
+    return series.to_numpy().astype(dtype)
+
+
+def write_snapshot(df, root=SNAPSHOT_DIR):
+    date_retrieved = pd.Timestamp(df.date_retrieved.iloc[0])
+    day_dir = os.path.join(root, date_retrieved.strftime(DAY_FORMAT))
+    os.makedirs(day_dir, exist_ok=True)
+    path = os.path.join(day_dir, date_retrieved.strftime(POLL_FORMAT) + ".npz")
+
+    # Write to a temporary name first so that readers never see a partial poll
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **{c: _to_array(df[c], t) for c, t in SCHEMA.items()})
+    os.replace(tmp_path, path)
+    return path
+
+
+def list_snapshots(root=SNAPSHOT_DIR, start=None, end=None):
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    if not os.path.isdir(root):
+        return []
+
+    paths = []
+    for day in sorted(os.listdir(root)):
+        try:
+            day_date = datetime.strptime(day, DAY_FORMAT)
+        except ValueError:
+            continue
+        if start is not None and day_date.date() < start.date():
+            continue
+        if end is not None and day_date.date() > end.date():
+            continue
+        for name in sorted(os.listdir(os.path.join(root, day))):
+            if not name.endswith(".npz"):
+                continue
+            poll_date = datetime.strptime(name[:-len(".npz")], POLL_FORMAT)
+            if start is not None and poll_date < start:
+                continue
+            if end is not None and poll_date > end:
+                continue
+            paths.append(os.path.join(root, day, name))
+    return paths
+
+
+def load_snapshot(path, columns=None):
+    columns = COLUMNS if columns is None else columns
+    with np.load(path) as data:
+        return pd.DataFrame({c: data[c] for c in columns})
+
+
+def iter_snapshots(root=SNAPSHOT_DIR, start=None, end=None, columns=None):
+    for path in list_snapshots(root, start, end):
+        yield load_snapshot(path, columns)
+
+
+def read_snapshots(root=SNAPSHOT_DIR, start=None, end=None, columns=None):
+    return _read_paths(list_snapshots(root, start, end), columns)
+
+
+def iter_snapshot_chunks(root=SNAPSHOT_DIR, start=None, end=None, columns=None, chunk_polls=CHUNK_POLLS):
+    # Consecutive polls read chunk_polls at a time, for histories which do not fit in memory
+    paths = list_snapshots(root, start, end)
+    for i in range(0, len(paths), chunk_polls):
+        yield _read_paths(paths[i:i + chunk_polls], columns)
+
+
+def _read_paths(paths, columns=None):
+    columns = COLUMNS if columns is None else columns
+    arrays = {c: [] for c in columns}
+    for path in paths:
+        # np.load only decompresses the members that are accessed
+        with np.load(path) as data:
+            for c in columns:
+                arrays[c].append(data[c])
+
+    if not arrays[columns[0]]:
+        return pd.DataFrame({c: np.array([], dtype=SCHEMA[c]) for c in columns})
+    return pd.DataFrame({c: np.concatenate(arrays[c]) for c in columns})
+
+
+def read_csv_history(csv_name, chunksize=None):
+    with open(csv_name) as f:
+        first_line = f.readline()
+
+    # request_and_write appends without a header, so only the very first poll may have written one
+    if "station_id" in first_line:
+        kwargs = dict(index_col=0)
+    else:
+        kwargs = dict(index_col=0, header=None, names=[""] + COLUMNS)
+    return pd.read_csv(csv_name, parse_dates=DATE_COLUMNS, chunksize=chunksize,
+                       dtype={"stationCode": str, "functioning_word": str}, **kwargs)
+
+
+def migrate_csv(csv_name=NAME_CSV, root=SNAPSHOT_DIR, chunksize=10 ** 6):
+    n_polls = 0
+    pending = None
+    for chunk in read_csv_history(csv_name, chunksize=chunksize):
+        if pending is not None:
+            chunk = pd.concat([pending, chunk])
+
+        # The last poll of a chunk may continue in the next one
+        last_date = chunk.date_retrieved.iloc[-1]
+        pending = chunk[chunk.date_retrieved == last_date]
+        chunk = chunk[chunk.date_retrieved != last_date]
+
+        for _, poll in chunk.groupby("date_retrieved", sort=False):
+            write_snapshot(poll, root)
+            n_polls += 1
+
+    if pending is not None and len(pending):
+        write_snapshot(pending, root)
+        n_polls += 1
+    return n_polls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Velib snapshot store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="Convert the legacy CSV history into snapshots")
+    migrate_parser.add_argument("csv_name", nargs="?", default=NAME_CSV)
+    migrate_parser.add_argument("--root", default=SNAPSHOT_DIR)
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        print("{} polls written to {}".format(migrate_csv(args.csv_name, args.root), args.root))
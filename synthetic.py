@@ -0,0 +1,85 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from api_calls import status_to_frame
+from storage import write_snapshot
+
+# Rough bounding box of the Velib network
+LAT_RANGE = (48.80, 48.92)
+LON_RANGE = (2.22, 2.47)
+RENTAL_METHODS = [["CREDITCARD"], None]
+
+
+def station_information_payload(n_stations=1500, seed=0):
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(*LAT_RANGE, n_stations)
+    lon = rng.uniform(*LON_RANGE, n_stations)
+    capacity = rng.integers(12, 70, n_stations)
+    stations = [{"station_id": 100000 + i,
+                 "stationCode": str(10000 + i),
+                 "name": "Station {}".format(i),
+                 "lat": float(lat[i]),
+                 "lon": float(lon[i]),
+                 "capacity": int(capacity[i]),
+                 "rental_methods": RENTAL_METHODS[i % 2]}
+                for i in range(n_stations)]
+    return {"lastUpdatedOther": int(datetime(2021, 9, 1).timestamp()), "ttl": 3600, "data": {"stations": stations}}
+
+
+def station_status_payload(information, date, rng):
+    stations = information["data"]["stations"]
+    capacity = np.array([x["capacity"] for x in stations])
+
+    # On working days residential stations empty in the morning and fill up again in the evening, business ones
+    # (every third station) the other way around. Weekends follow a flatter daily cycle with a per-station phase.
+    hour = date.hour + date.minute / 60
+    n_stations = len(stations)
+    if date.weekday() < 5:
+        at_work = 1 / (1 + np.exp(-2 * (hour - 8.5))) - 1 / (1 + np.exp(-2 * (hour - 18.5)))
+        fill = np.where(np.arange(n_stations) % 3 == 0, 0.2 + 0.6 * at_work, 0.8 - 0.6 * at_work)
+    else:
+        phase = (np.arange(n_stations) * 2.399) % (2 * np.pi)
+        fill = 0.5 + 0.2 * np.sin(2 * np.pi * hour / 24 + phase)
+    fill = fill + rng.normal(0, 0.1, n_stations)
+    bikes = np.clip(np.round(fill * capacity), 0, capacity).astype(int)
+    ebikes = rng.binomial(bikes, 0.35)
+    mech = bikes - ebikes
+    renting = (rng.random(n_stations) > 0.01).astype(int)
+    last_reported = int(date.timestamp()) - rng.integers(0, 900, n_stations)
+
+    status = [{"stationCode": x["stationCode"],
+               "station_id": x["station_id"],
+               "num_bikes_available": int(bikes[i]),
+               "numBikesAvailable": int(bikes[i]),
+               "num_bikes_available_types": [{"mechanical": int(mech[i])}, {"ebike": int(ebikes[i])}],
+               "num_docks_available": int(capacity[i] - bikes[i]),
+               "numDocksAvailable": int(capacity[i] - bikes[i]),
+               "is_installed": 1,
+               "is_returning": int(renting[i]),
+               "is_renting": int(renting[i]),
+               "last_reported": int(last_reported[i])}
+              for i, x in enumerate(stations)]
+    return {"lastUpdatedOther": int(date.timestamp()), "ttl": 60, "data": {"stations": status}}
+
+
+def poll_dates(n_polls, start=datetime(2021, 9, 6, 0, 7, 12), period=timedelta(minutes=15)):
+    return [start + k * period for k in range(n_polls)]
+
+
+def status_payloads(information, n_polls, seed=0, **kwargs):
+    rng = np.random.default_rng(seed)
+    for date in poll_dates(n_polls, **kwargs):
+        yield date, station_status_payload(information, date, rng)
+
+
+def write_history(root, information, n_polls, seed=0, information_path=None, **kwargs):
+    # Snapshot store of n_polls polls, as the collector would have written them
+    os.makedirs(root, exist_ok=True)
+    if information_path is not None:
+        with open(information_path, "w") as f:
+            json.dump(information, f)
+    for date, data in status_payloads(information, n_polls, seed, **kwargs):
+        write_snapshot(status_to_frame(data, date), root)